@@ -0,0 +1,186 @@
+import argparse
+import csv
+import json
+import os
+import random
+
+import zstandard
+
+from pathlib import Path
+
+
+# noun stems with masculine singular, feminine singular, masculine plural, feminine plural, neutral singular and plural
+# suffixes, combined with the prefixes below into compounds such as Projektleiter, Projektleiterin, Projektleitung
+BASES = [
+    ("leiter", "leiterin", "leiter", "leiterinnen", "leitung", "leitungen"),
+    ("lehrer", "lehrerin", "lehrer", "lehrerinnen", "lehrkraft", "lehrkräfte"),
+    ("berater", "beraterin", "berater", "beraterinnen", "beratung", "beratungen"),
+    ("vertreter", "vertreterin", "vertreter", "vertreterinnen", "vertretung", "vertretungen"),
+    ("mitarbeiter", "mitarbeiterin", "mitarbeiter", "mitarbeiterinnen", "mitarbeitende", "mitarbeitenden"),
+    ("helfer", "helferin", "helfer", "helferinnen", "hilfe", "hilfen"),
+    ("planer", "planerin", "planer", "planerinnen", "planung", "planungen"),
+    ("kaufmann", "kauffrau", "kaufleute", "kauffrauen", "kaufleute", "kaufleute"),
+]
+PREFIXES = [
+    "Projekt", "Schul", "Team", "Betriebs", "Verkaufs", "Kunden", "Bau", "Finanz", "Rechts", "Sprach",
+    "Reise", "Energie", "Medien", "Kultur", "Sport", "Umwelt", "Garten", "Haus", "Stadt", "Land",
+]
+FILLER = [
+    "heute", "wir", "haben", "das", "neue", "Konzept", "gestern", "vorgestellt", "und", "alle", "waren", "sehr",
+    "zufrieden", "mit", "dem", "Ergebnis", "der", "Sitzung", "im", "Rathaus", "die", "Woche", "beginnt", "früh",
+    "am", "Montag", "mehrere", "Termine", "stehen", "noch", "aus", "ein", "kurzer", "Bericht", "folgt", "später",
+]
+VERBS = ["trifft", "sucht", "lobt", "informiert", "begrüßt", "unterstützt", "kritisiert", "fragt"]
+
+
+def generate_terminology(n_terms):
+    """
+    Returns n_terms rows of a terminology in the format read by Terminology, all of type neut.
+    The first rows combine every base with the first prefix, so that small terminologies still cover all bases.
+    Once all prefixes are used, two prefixes are combined (e.g. Projektschulleiter).
+    """
+    prefixes = PREFIXES + [first + second.lower() for first in PREFIXES for second in PREFIXES if first != second]
+    rows = []
+    for i in range(n_terms):
+        prefix = prefixes[(i // len(BASES)) % len(prefixes)]
+        # prefixes are repeated with a number once all combinations are used
+        if i >= len(BASES) * len(prefixes):
+            prefix = f"{prefix}{i // (len(BASES) * len(prefixes))}"
+        masc_sg, fem_sg, masc_pl, fem_pl, neut_sg, neut_pl = (f"{prefix}{form}" for form in BASES[i % len(BASES)])
+        rows.append(["neut", masc_sg, "", masc_sg, fem_sg, masc_pl, fem_pl, neut_sg, neut_pl])
+    return rows
+
+
+def write_terminology(rows, outfile):
+    with open(outfile, "w", encoding="utf-8", newline="") as outf:
+        writer = csv.writer(outf, delimiter=";")
+        writer.writerow(
+            [
+                "type",
+                "term",
+                "alternative",
+                "singular_masculine",
+                "singular_feminine",
+                "plural_masculine",
+                "plural_feminine",
+                "singular_gender_neutral",
+                "plural_gender_neutral",
+            ]
+        )
+        writer.writerows(rows)
+
+
+def generate_sentence(rng, terms, match_rate):
+    """Returns a sentence of filler words. With probability match_rate it contains one term in a random form."""
+    words = rng.choices(FILLER, k=rng.randint(6, 16))
+    if terms and rng.random() < match_rate:
+        row = rng.choice(terms)
+        term = row[rng.choice([3, 4, 5, 6, 7])]
+        words.insert(rng.randrange(len(words) + 1), f"{term} {rng.choice(VERBS)}")
+    words[0] = words[0].capitalize()
+    return " ".join(words) + "."
+
+
+def generate_oscar_doc(rng, terms, match_rate, doc_id):
+    """Returns an OSCAR 22.01 style record: content, warc headers and metadata."""
+    paragraphs = [
+        " ".join(generate_sentence(rng, terms, match_rate) for _ in range(rng.randint(1, 6)))
+        for _ in range(rng.randint(1, 5))
+    ]
+    content = "\n".join(paragraphs)
+    return {
+        "content": content,
+        "warc_headers": {
+            "warc-record-id": f"<urn:uuid:{rng.getrandbits(128):032x}>",
+            "warc-target-uri": f"https://example.org/{doc_id}",
+            "content-length": str(len(content.encode("utf-8"))),
+            "content-type": "text/plain",
+            "warc-type": "conversion",
+        },
+        "metadata": {
+            "identification": {"label": "de", "prob": round(rng.uniform(0.6, 1.0), 4)},
+            "annotation": rng.choice([None, None, None, ["tiny"], ["short_sentences"], ["header"], ["adult"]]),
+            "sentence_identifications": [
+                {"label": "de", "prob": round(rng.uniform(0.6, 1.0), 4)} for _ in paragraphs
+            ],
+        },
+    }
+
+
+def write_oscar(rng, terms, n_docs, n_files, match_rate, outdir):
+    os.makedirs(outdir, exist_ok=True)
+    cctx = zstandard.ZstdCompressor(level=3)
+    for i in range(n_files):
+        # the documents are distributed evenly over the files
+        n_file_docs = n_docs // n_files + (1 if i < n_docs % n_files else 0)
+        with zstandard.open(Path(outdir) / f"de_meta_part_{i + 1}.jsonl.zst", "wt", cctx=cctx, encoding="utf-8") as outf:
+            for j in range(n_file_docs):
+                doc = generate_oscar_doc(rng, terms, match_rate, f"{i}-{j}")
+                outf.write(f"{json.dumps(doc, ensure_ascii=False)}\n")
+
+
+def write_segments(segments, outfile):
+    with open(outfile, "w", encoding="utf-8") as outf:
+        outf.writelines(f"{seg}\n" for seg in segments)
+
+
+def generate(outdir, n_docs, n_segments, n_terms=500, n_files=4, match_rate=0.3, seed=1234):
+    """
+    Writes a synthetic data set to outdir, the same for the same arguments:
+    terminology.csv, oscar/*.jsonl.zst with n_docs documents, segments.txt with n_segments segments
+    that is also split into segments/ for replace.py, gendered and neutral versions of the segments in eval/src and
+    eval/trg for exact_match_accuracy.py and a reference and two hypotheses in eval/ for wer.py.
+    """
+    rng = random.Random(seed)
+    outdir = Path(outdir)
+    os.makedirs(outdir / "segments", exist_ok=True)
+    os.makedirs(outdir / "eval" / "src", exist_ok=True)
+    os.makedirs(outdir / "eval" / "trg", exist_ok=True)
+
+    terms = generate_terminology(n_terms)
+    write_terminology(terms, outdir / "terminology.csv")
+    write_oscar(rng, terms, n_docs, n_files, match_rate, outdir / "oscar")
+
+    segments = [generate_sentence(rng, terms, match_rate) for _ in range(n_segments)]
+    write_segments(segments, outdir / "segments.txt")
+    for i in range(n_files):
+        write_segments(segments[i::n_files], outdir / "segments" / f"segments.{i + 1}.txt")
+
+    # every evaluation segment contains a masculine singular term, the target contains its neutral form
+    src, trg = [], []
+    for _ in range(n_segments):
+        row = rng.choice(terms)
+        sentence = generate_sentence(rng, [], 0.0)
+        src.append(f"{row[3]} {rng.choice(VERBS)} {sentence}")
+        trg.append(f"{row[7]} {rng.choice(VERBS)} {sentence}")
+    write_segments(src, outdir / "eval" / "src" / "1.txt")
+    write_segments(trg, outdir / "eval" / "trg" / "1.txt")
+    write_segments(trg, outdir / "eval" / "ref.txt")
+    write_segments(src, outdir / "eval" / "hyp1.txt")
+    write_segments([seg if rng.random() < 0.5 else ref for seg, ref in zip(src, trg)], outdir / "eval" / "hyp2.txt")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic data set for the benchmarks.")
+    parser.add_argument("--outdir", required=True, help="Directory where the data set is written to")
+    parser.add_argument("--docs", type=int, default=10000, help="Number of OSCAR documents. Defaults to 10000.")
+    parser.add_argument("--segments", type=int, default=10000, help="Number of segments. Defaults to 10000.")
+    parser.add_argument("--terms", type=int, default=500, help="Number of terminology rows. Defaults to 500.")
+    parser.add_argument("--files", type=int, default=4, help="Number of OSCAR and segment files. Defaults to 4.")
+    parser.add_argument(
+        "--match-rate",
+        type=float,
+        default=0.3,
+        help="Probability that a sentence contains a term. Defaults to 0.3.",
+    )
+    parser.add_argument("--seed", type=int, default=1234)
+    return parser.parse_args()
+
+
+def main(args):
+    generate(args.outdir, args.docs, args.segments, args.terms, args.files, args.match_rate, args.seed)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+from generate_data import generate
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# components whose work is split over several processes, the others are run with a single core only
+PARALLEL_COMPONENTS = ["term_matcher", "term_counter", "replacer", "filter"]
+COMPONENTS = PARALLEL_COMPONENTS + ["fuzzy_match_accuracy", "paired_bootstrap_resampling"]
+
+
+def make_tools_dir(workdir):
+    """
+    Links the scripts of data_creation and evaluation into workdir/tools, the package layout the scripts
+    import each other from, and returns workdir.
+    """
+    tools_dir = Path(workdir) / "tools"
+    os.makedirs(tools_dir, exist_ok=True)
+    for script in sorted((REPO_DIR / "data_creation").glob("*.py")) + sorted((REPO_DIR / "evaluation").glob("*.py")):
+        link = tools_dir / script.name
+        if not link.exists():
+            os.symlink(script, link)
+    return workdir
+
+
+def get_command(component, data, outdir, cores):
+    """Returns the command running component on data and the number of documents or segments it processes."""
+    term = str(data / "terminology.csv")
+    if component == "term_matcher":
+        for subdir in ["doc", "neutral", "gendered", "both", "unmatched"]:
+            os.makedirs(outdir / subdir, exist_ok=True)
+        command = ["tools.frequencies", "--inpath", data / "oscar", "--terminology", term]
+        command += ["--extracted", outdir, "--count", outdir / "counts.csv", "--cores", cores]
+    elif component == "term_counter":
+        command = ["tools.frequencies", "--count-only", "--inpath", data / "segments.txt", "--terminology", term]
+        command += ["--count", outdir / "counts.csv", "--cores", cores]
+    elif component == "replacer":
+        command = ["tools.replace", "--terminology", term, "--segments", data / "segments"]
+        command += ["--outprefix", outdir, "--cores", cores]
+    elif component == "filter":
+        command = ["tools.filter_by_terms", "--terminology", term, "--src-segments", data / "segments.txt"]
+        command += ["--trg-segments", data / "segments.txt", "--outprefix", outdir / "out", "--cores", cores]
+    elif component == "fuzzy_match_accuracy":
+        command = ["tools.exact_match_accuracy", "--source-path", data / "eval" / "src", "--target-path", data / "eval" / "trg"]
+        command += ["--terminology-path", term, "--model", "benchmark", "--out-file", outdir / "accuracy.csv"]
+    else:
+        command = ["tools.wer", "-r", data / "eval" / "ref.txt", "--test-significance", "-n", "100"]
+        command += ["--hypotheses", data / "eval" / "hyp1.txt", data / "eval" / "hyp2.txt"]
+    return [sys.executable, "-m"] + [str(arg) for arg in command]
+
+
+def get_startup_code(component, data, outdir):
+    """Returns python code importing component and setting it up on the terminology of data without processing anything."""
+    term = str(data / "terminology.csv")
+    if component == "term_matcher":
+        return f"from tools.frequencies import Terminology, TermMatcher; TermMatcher({str(data / 'oscar')!r}, Terminology({term!r}), 'LEMMA')"
+    if component == "term_counter":
+        return f"from tools.frequencies import Terminology, TermCounter; TermCounter(Terminology({term!r}), 'LEMMA')"
+    if component == "replacer":
+        return f"from tools.frequencies import Terminology; from tools.replace import Replacer; Replacer(Terminology({term!r}), {str(outdir)!r})"
+    if component == "filter":
+        return f"from tools.frequencies import Terminology; from tools.filter_by_terms import Filter; Filter(Terminology({term!r}))"
+    if component == "fuzzy_match_accuracy":
+        return (
+            f"from tools.frequencies import Terminology; from tools.exact_match_accuracy import get_matcher; "
+            f"t = Terminology({term!r}); get_matcher(t.gendered_terms, t)"
+        )
+    return "import tools.wer"
+
+
+def run(command, cwd, env, log):
+    """Runs command and returns its wall time in seconds, the peak RSS of its largest process in MB and its return code."""
+    start = time.perf_counter()
+    with open(log, "a", encoding="utf-8") as logf:
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdout=logf, stderr=subprocess.STDOUT)
+        # the resource usage of this child and all its waited for descendants, e.g. the pool workers
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is given in kilobytes on Linux
+    return wall, usage.ru_maxrss / 1024, process.returncode
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    workdir = Path(make_tools_dir(Path(args.workdir).resolve()))
+    env = dict(os.environ, PYTHONPATH=str(workdir))
+    revision = get_revision()
+    components = args.components or COMPONENTS
+    for scale in args.scales:
+        data = workdir / "data" / f"scale_{scale}"
+        if not (data / "terminology.csv").exists():
+            print(f"Generating data set with {scale} documents and segments in {data}", flush=True)
+            generate(data, scale, scale, n_terms=args.terms, n_files=args.files, seed=args.seed)
+        for component in components:
+            outdir = workdir / "out" / component
+            shutil.rmtree(outdir, ignore_errors=True)
+            os.makedirs(outdir)
+            log = workdir / f"{component}.log"
+            startup, _, _ = run([sys.executable, "-c", get_startup_code(component, data, outdir)], workdir, env, log)
+            for cores in args.cores if component in PARALLEL_COMPONENTS else [1]:
+                for repetition in range(args.repeat):
+                    shutil.rmtree(outdir, ignore_errors=True)
+                    os.makedirs(outdir)
+                    print(f"Running {component} on scale {scale} with {cores} cores ({repetition + 1}/{args.repeat})", flush=True)
+                    wall, peak_rss, returncode = run(get_command(component, data, outdir, cores), workdir, env, log)
+                    result = {
+                        "component": component,
+                        "scale": scale,
+                        "cores": cores,
+                        "repetition": repetition,
+                        "items": scale,
+                        "wall_s": wall,
+                        "items_per_s": scale / wall,
+                        "startup_s": startup,
+                        "peak_rss_mb": peak_rss,
+                        "returncode": returncode,
+                        "revision": revision,
+                        "python": platform.python_version(),
+                        "machine": platform.machine(),
+                        "cpu_count": os.cpu_count(),
+                        "time": time.time(),
+                    }
+                    if returncode:
+                        print(f"{component} failed with return code {returncode}, see {log}", flush=True)
+                    with open(args.results, "a", encoding="utf-8") as outf:
+                        outf.write(f"{json.dumps(result)}\n")
+
+
+def load_results(path):
+    """Returns the fastest successful run per component, scale and cores of a results file."""
+    results = {}
+    with open(path, "r", encoding="utf-8") as inf:
+        for line in inf:
+            result = json.loads(line)
+            key = (result["component"], result["scale"], result["cores"])
+            if result["returncode"] == 0 and (key not in results or result["wall_s"] < results[key]["wall_s"]):
+                results[key] = result
+    return results
+
+
+def compare(baseline_path, results_path):
+    baseline, results = load_results(baseline_path), load_results(results_path)
+    print(f"{'component':<30}{'scale':>10}{'cores':>6}{'items/s':>12}{'speedup':>9}{'peak MB':>9}{'rss ratio':>10}")
+    for key in sorted(results):
+        result = results[key]
+        speedup, rss_ratio = "", ""
+        if key in baseline:
+            speedup = f"{result['items_per_s'] / baseline[key]['items_per_s']:.2f}x"
+            rss_ratio = f"{result['peak_rss_mb'] / baseline[key]['peak_rss_mb']:.2f}x"
+        print(f"{key[0]:<30}{key[1]:>10}{key[2]:>6}{result['items_per_s']:>12.1f}{speedup:>9}{result['peak_rss_mb']:>9.0f}{rss_ratio:>10}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the extraction, replacement, filtering and evaluation scripts on synthetic data.")
+    parser.add_argument("--workdir", default="benchmark_runs", help="Directory for the generated data, outputs and logs")
+    parser.add_argument("--results", default="benchmark_results.jsonl", help="File the results are appended to as json lines")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000], help="Numbers of documents and segments")
+    parser.add_argument("--cores", type=int, nargs="+", default=[1, 2, 4], help="Numbers of cores for the parallel components")
+    parser.add_argument("--components", nargs="+", choices=COMPONENTS, help="Components to run. Defaults to all.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per setting, compare uses the fastest")
+    parser.add_argument("--terms", type=int, default=500, help="Number of terminology rows")
+    parser.add_argument("--files", type=int, default=4, help="Number of OSCAR and segment files")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="Don't run anything, but compare --results with the results file BASELINE of an earlier revision.",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    if args.compare:
+        compare(args.compare, args.results)
+    else:
+        run_benchmarks(args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
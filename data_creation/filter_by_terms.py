@@ -1,14 +1,30 @@
 import argparse
-import spacy
+import collections
 import logging
+import os
 import time
 import itertools
+import uuid
 from multiprocessing import Pool, cpu_count
-from tools.frequencies import Terminology, Term
-from spacy.matcher import PhraseMatcher
+from tools.frequencies import (
+    OUTPUT_BUFFER_SIZE,
+    BackgroundWriter,
+    Metrics,
+    Terminology,
+    get_spacy_model,
+    imap_bounded,
+    init_worker,
+    open_input,
+    timed,
+    worker_task,
+)
 
 
-SPACY_MODEL = spacy.load("de_core_news_sm", disable=["morphologizer", "parser", "ner"])
+SPACY_EXCLUDE = ["morphologizer", "parser", "ner"]
+
+
+def get_model():
+    return get_spacy_model(exclude=SPACY_EXCLUDE, enable=[])
 
 
 
@@ -21,7 +37,7 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 class Filter:
-    def __init__(self, terminology, match_level="lemma", target="all"):
+    def __init__(self, terminology, match_level="lemma", target="all", metrics=None):
         self.terminology = terminology
         self.match_level = match_level
         if target == "m":
@@ -30,13 +46,17 @@ class Filter:
             self.terms = self.terminology.feminine_terms
         else:
             self.terms = self.terminology.terms_by_id
+        self.handle = uuid.uuid4().hex
         self.matcher = self._get_matcher(self.terms)
+        self.metrics = metrics or Metrics(name="filter")
 
     def _get_matcher(self, terms):
         # create spacy docs for terms
         # TODO: should stopwords be removed?
+        from spacy.matcher import PhraseMatcher
+
         terms = {i: term.term for i, term in terms.items()}
-        prep_terms = list(SPACY_MODEL.pipe(terms.values()))
+        prep_terms = self.terminology.get_patterns(terms.keys(), get_model())
         # initialize PhraseMatcher
         matcher = PhraseMatcher(prep_terms[0].vocab, attr=self.match_level)
         for term_id, term in zip(terms.keys(), prep_terms):
@@ -70,39 +90,57 @@ class Filter:
     
     def filter(self, src_segments_file, trg_segments_file, outprefix, nr_cpus=None, chunk_size=500000):
 
-        num_cpus = nr_cpus or (cpu_count() // 2)
+        num_cpus = nr_cpus or max(1, cpu_count() // 2)
         logger.info(f"Running on {num_cpus} CPUs")
 
         src_out = f"{outprefix}.filtered.src"
         trg_out = f"{outprefix}.filtered.trg"
         removed = 0
-        with Pool(processes=num_cpus) as pool:
-            with open(src_segments_file, "r", encoding="utf-8") as src_segments, open(trg_segments_file, "r", encoding="utf-8") as trg_segments, open(src_out, "w", encoding="utf-8") as src_outf,  open(trg_out, "w", encoding="utf-8") as trg_outf:
+        with Pool(processes=num_cpus, initializer=init_worker, initargs=(self,)) as pool:
+            with open_input(src_segments_file) as src_segments, open_input(trg_segments_file) as trg_segments, open(src_out, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE) as src_outf, open(trg_out, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE) as trg_outf:
                 logger.info(f"Starting filtering {src_segments_file}...")
                 start = time.time()
 
                 # create chunks from the spacy docs
-                chunks = self._generate_chunks(src_segments, trg_segments, chunk_size)
-                results = pool.map(self._process_chunk, chunks)
-
-                for filtered_segs, n_filtered_out in results:
-                    removed += n_filtered_out
-                    for src_seg, trg_seg in filtered_segs:
-                        src_outf.write(src_seg)
-                        trg_outf.write(trg_seg)
+                chunks = timed(self._generate_chunks(src_segments, trg_segments, chunk_size), self.metrics.seconds, "read")
+                results = imap_bounded(pool, worker_task(self, "_process_chunk"), chunks, num_cpus * 2)
+
+                # the filtered segments are written while the next chunks are matched
+                with BackgroundWriter() as background:
+                    for filtered_segs, stats in results:
+                        removed += stats["removed"]
+                        self.metrics.add(stats)
+                        self.metrics.set_queue("write", background.queue.qsize())
+                        self.metrics.maybe_export()
+                        background.submit(self._write_segments, filtered_segs, src_outf, trg_outf)
 
                 end = time.time()
                 logger.info(f"Done after {end - start}s! {removed} segments were removed")
+        self.metrics.export()
+        self.metrics.log_summary()
 
 
+    @staticmethod
+    def _write_segments(segs, src_outf, trg_outf):
+        src_outf.writelines(src_seg for src_seg, _ in segs)
+        trg_outf.writelines(trg_seg for _, trg_seg in segs)
+
     def _process_chunk(self, chunk):
+        seconds = collections.Counter()
+        stats = {"docs": len(chunk), "tokens": 0, "removed": 0, "seconds": seconds, "pid": os.getpid()}
+        start = time.perf_counter()
         src_segs = (pair[0] for pair in chunk)
         trg_segs = (pair[1] for pair in chunk)
-        src_seg_docs = SPACY_MODEL.pipe(src_segs)
-        trg_seg_docs = SPACY_MODEL.pipe(trg_segs)
-        filtered_segs = [(src_seg.text, trg_seg.text) for src_seg, trg_seg in zip(src_seg_docs, trg_seg_docs) if self._keep_segment(src_seg)]
-        filtered_out = len(chunk) - len(filtered_segs)
-        return filtered_segs, filtered_out
+        src_seg_docs = get_model().pipe(src_segs)
+        trg_seg_docs = get_model().pipe(trg_segs)
+        filtered_segs = []
+        for src_seg, trg_seg in timed(zip(src_seg_docs, trg_seg_docs), seconds, "pipe"):
+            stats["tokens"] += len(src_seg) + len(trg_seg)
+            if self._keep_segment(src_seg):
+                filtered_segs.append((src_seg.text, trg_seg.text))
+        stats["removed"] = len(chunk) - len(filtered_segs)
+        seconds["match"] = time.perf_counter() - start - seconds["pipe"]
+        return filtered_segs, stats
 
 
     def _keep_segment(self, segment):
@@ -137,15 +175,34 @@ def parse_args():
         "--cores",
         type=int
     )
+    parser.add_argument(
+        "--terminology-cache",
+        help="Directory where the parsed terminology and the spaCy docs of its terms are cached for later runs.",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Export throughput, time per stage and worker utilization to this file periodically. Appends json lines, or writes a Prometheus textfile if the path ends with .prom.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=30.0,
+        help="Seconds between two exports of --metrics. Defaults to 30.",
+    )
     return parser.parse_args()
 
 
 def main(args):
-    terminology = Terminology(args.terminology)
+    terminology = Terminology(args.terminology, cache_dir=args.terminology_cache)
     logger.info(f"Terminology is loaded.")
-    f = Filter(terminology, match_level=args.match_level, target=args.target)
+    f = Filter(
+        terminology,
+        match_level=args.match_level,
+        target=args.target,
+        metrics=Metrics(args.metrics, args.metrics_interval, name="filter"),
+    )
     logger.info("Filter is initialized.")
-    f.filter(args.src_segments, args.trg_segments, args.outprefix, nr_cpus=5, chunk_size=1000)
+    f.filter(args.src_segments, args.trg_segments, args.outprefix, nr_cpus=args.cores or 5, chunk_size=1000)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,40 @@
 import argparse
+import bisect
+import collections
+import cProfile
 import csv
+import functools
 import gzip
+import hashlib
 import io
 import json
 import logging
+import os
+import pstats
+import queue
+import re
+import shutil
+import threading
 import time
 import itertools
+import types
+import uuid
 
-import spacy
-from nltk.corpus import stopwords
+import numpy as np
 from pathlib import Path
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Lock, Pool, RawArray, RawValue, cpu_count
 
 import zstandard
-from spacy.matcher import PhraseMatcher
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Create a logger
 logger = logging.getLogger(__name__)
@@ -23,9 +44,688 @@ formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-SPACY_MODEL = spacy.load("de_core_news_sm", disable=["morphologizer", "parser", "ner"])
-SPACY_MODEL.enable_pipe("senter")
-DE_STOPWORDS = stopwords.words("german")
+SPACY_MODEL_NAME = "de_core_news_sm"
+# components that are never used for matching aren't loaded at all
+SPACY_EXCLUDE = ["morphologizer", "parser", "ner"]
+SPACY_ENABLE = ["senter"]
+# longer documents are matched in windows of at most this many characters
+MAX_WINDOW_CHARS = 100000
+# number of characters run through spaCy in one batch
+BATCH_CHARS = 500000
+
+# spaCy models and stopword lists are only loaded on first use, once per process and configuration
+_SPACY_MODELS = {}
+_STOPWORDS = {}
+# set once a Profiler is started, the components of the spaCy models are then wrapped with ProfiledComponent
+_PROFILE_COMPONENTS = False
+
+
+def get_spacy_model(exclude=SPACY_EXCLUDE, enable=SPACY_ENABLE):
+    """
+    Returns the spaCy model without the excluded and with the additionally enabled components.
+    spaCy itself is only imported here, so that importing the scripts (e.g. for --help) stays fast.
+    """
+    key = (tuple(exclude), tuple(enable))
+    if key not in _SPACY_MODELS:
+        import spacy
+
+        model = spacy.load(SPACY_MODEL_NAME, exclude=list(exclude))
+        for pipe in enable:
+            model.enable_pipe(pipe)
+        if _PROFILE_COMPONENTS:
+            profile_components(model)
+        _SPACY_MODELS[key] = model
+        logger.info(f"Loaded {SPACY_MODEL_NAME} with components {model.pipe_names}.")
+    return _SPACY_MODELS[key]
+
+
+def _pipe_component(component, docs, kwargs):
+    if hasattr(component, "pipe"):
+        yield from component.pipe(docs, **kwargs)
+    else:
+        kwargs.pop("batch_size", None)
+        for doc in docs:
+            yield component(doc, **kwargs)
+
+
+class ProfiledComponent:
+    """
+    Wraps a component of a spaCy pipeline while profiling, so that the time of the component shows up under a
+    function named spacy_component_<name>. spaCy runs all components through the same generator and components
+    implemented in Cython don't show up in cProfile at all, so their time can't be told apart otherwise.
+    """
+
+    def __init__(self, name, component):
+        self.name = name
+        self.component = component
+        # cProfile tells functions apart by their code objects, so every component gets a renamed copy
+        code = _pipe_component.__code__.replace(co_name=f"spacy_component_{name}", co_qualname=f"spacy_component_{name}")
+        self._pipe = types.FunctionType(code, _pipe_component.__globals__)
+
+    def __call__(self, doc, **kwargs):
+        return next(self._pipe(self.component, [doc], kwargs))
+
+    def pipe(self, docs, **kwargs):
+        return self._pipe(self.component, docs, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.component, name)
+
+
+def profile_components(model):
+    """Wraps the components of model with ProfiledComponent, if they aren't already."""
+    for i, (name, component) in enumerate(model._components):
+        if not isinstance(component, ProfiledComponent):
+            model._components[i] = (name, ProfiledComponent(name, component))
+
+
+def get_stopwords(language="german", nltk_data_path=None):
+    if language not in _STOPWORDS:
+        import nltk
+
+        if nltk_data_path and nltk_data_path not in nltk.data.path:
+            nltk.data.path.append(nltk_data_path)
+        from nltk.corpus import stopwords
+
+        _STOPWORDS[language] = set(stopwords.words(language))
+    return _STOPWORDS[language]
+
+
+def get_phrase_matcher(terminology, terms, match_level):
+    """Returns a PhraseMatcher of terms by id at match_level with the term ids as match ids, leaving out stopwords."""
+    from spacy.matcher import PhraseMatcher
+
+    terms = {i: term.term for i, term in terms.items() if term.term not in get_stopwords()}
+    prep_terms = terminology.get_patterns(terms.keys(), get_spacy_model())
+    matcher = PhraseMatcher(prep_terms[0].vocab, attr=match_level)
+    for term_id, term in zip(terms.keys(), prep_terms):
+        matcher.add(str(term_id), [term])
+    return matcher
+
+
+# objects registered by the pool initializer, kept resident in the worker process together with their PhraseMatchers
+_WORKER_OBJECTS = {}
+# profiler of the worker process if the registered object has a profile_dir
+_WORKER_PROFILER = None
+
+
+def init_worker(obj):
+    """
+    Pool initializer: registers obj in the worker process under its handle.
+    obj is transferred (and its PhraseMatchers compiled) only once per worker instead of once per task.
+    """
+    global _WORKER_PROFILER
+    # the profiler of the main process is still enabled in forked workers, they only record their tasks themselves
+    if Profiler.active:
+        Profiler.active.profile.disable()
+        Profiler.active = None
+    _WORKER_OBJECTS[obj.handle] = obj
+    if getattr(obj, "profile_dir", None):
+        _WORKER_PROFILER = Profiler(obj.profile_dir, role="worker")
+
+
+def _call_in_worker(handle, method_name, *args):
+    if _WORKER_PROFILER is None:
+        return getattr(_WORKER_OBJECTS[handle], method_name)(*args)
+    with _WORKER_PROFILER:
+        return getattr(_WORKER_OBJECTS[handle], method_name)(*args)
+
+
+def worker_task(obj, method_name):
+    """
+    Returns a picklable callable running obj.method_name in a worker that was set up with init_worker.
+    Only the handle and the method name are sent with each task.
+    """
+    return functools.partial(_call_in_worker, obj.handle, method_name)
+
+
+# the metadata fields of OSCAR documents that are kept, everything else but the content is dropped on reading
+OSCAR_METADATA_FIELDS = ["identification", "annotation", "quality_warnings", "categories", "harmful_pp"]
+
+
+class OscarRecord:
+    """
+    The content and the kept metadata of an OSCAR document together with its raw json line,
+    which is written to the doc outputs as is, and its index and byte offset in the decompressed file,
+    which are written to the provenance outputs. Only the content and the metadata are pickled.
+    Documents read from a byte range of a zstd file have their offset in the data decompressed from the frame
+    starting at byte frame of the file and no index.
+    """
+
+    __slots__ = ("content", "metadata", "raw", "index", "offset", "frame")
+
+    def __init__(self, content, metadata, raw=None, index=None, offset=None, frame=0):
+        self.content = content
+        self.metadata = metadata
+        self.raw = raw
+        self.index = index
+        self.offset = offset
+        self.frame = frame
+
+    def __reduce__(self):
+        return OscarRecord, (self.content, self.metadata)
+
+
+def decode_oscar_record(line, index=None, offset=None, frame=0):
+    """Decodes a json line of an OSCAR file, using orjson if it is installed."""
+    doc = orjson.loads(line) if orjson else json.loads(line)
+    metadata = doc.get("metadata") or {}
+    fields = {field: metadata.get(field) for field in OSCAR_METADATA_FIELDS}
+    return OscarRecord(doc["content"], fields, line.rstrip(b"\r\n"), index, offset, frame)
+
+
+def decode_oscar_lines(lines, index=0, offset=0, frame=0):
+    """
+    Decodes consecutive raw lines of an OSCAR file, the first one being record index at byte offset.
+    index is None if it isn't known.
+    """
+    records = []
+    for i, line in enumerate(lines):
+        records.append(decode_oscar_record(line, None if index is None else index + i, offset, frame))
+        offset += len(line)
+    return records
+
+
+# buffer size of plain output files, results are written in batches anyway
+OUTPUT_BUFFER_SIZE = 1 << 20
+# output codecs and the suffixes of the files written with them
+CODEC_SUFFIXES = {"zstd": ".zst", "gzip": ".gz", "plain": ""}
+# magic bytes by which open_input recognizes compressed files
+CODEC_MAGIC = {"zstd": b"\x28\xb5\x2f\xfd", "gzip": b"\x1f\x8b"}
+
+
+def open_output(path, mode="wt", codec="plain", level=None, threads=1):
+    """
+    Opens path for writing with the given codec. path gets no suffix added.
+    With threads > 0, zstd compresses in that many background threads instead of the calling thread.
+    """
+    encoding = None if "b" in mode else "utf-8"
+    if codec == "zstd":
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads)
+        return zstandard.open(path, mode, cctx=cctx, encoding=encoding)
+    if codec == "gzip":
+        return gzip.open(path, mode, compresslevel=9 if level is None else level, encoding=encoding)
+    return open(path, mode, buffering=OUTPUT_BUFFER_SIZE, encoding=encoding)
+
+
+def detect_codec(path):
+    """Returns the codec of path according to its magic bytes, files of any other format are plain."""
+    with open(path, "rb") as inf:
+        magic = inf.read(4)
+    for codec, codec_magic in CODEC_MAGIC.items():
+        if magic.startswith(codec_magic):
+            return codec
+    return "plain"
+
+
+class FileRange(io.RawIOBase):
+    """The bytes from start to end, or to the end of the file, of path read as a file of their own."""
+
+    def __init__(self, path, start=0, end=None):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.remaining = None if end is None else end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer) if self.remaining is None else min(len(buffer), self.remaining)
+        n = self.file.readinto(memoryview(buffer)[:size])
+        if self.remaining is not None:
+            self.remaining -= n
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_input(path, mode="rt", start=0, end=None):
+    """
+    Opens path for reading, decompressing it according to its magic bytes. With start or end, only these bytes
+    of the file are read. For zstd files they have to be frame boundaries, gzip files can only be read as a whole.
+    """
+    encoding = None if "b" in mode else "utf-8"
+    codec = detect_codec(path)
+    if codec == "gzip":
+        if start or end is not None:
+            raise ValueError(f"{path} is gzipped and can't be read from a byte range.")
+        return gzip.open(path, mode, encoding=encoding)
+    if codec == "plain" and not start and end is None:
+        return open(path, mode, encoding=encoding)
+    reader = FileRange(path, start, end)
+    if codec == "zstd":
+        # merged part files consist of several zstd frames
+        reader = zstandard.ZstdDecompressor().stream_reader(reader, read_across_frames=True, closefd=True)
+    reader = io.BufferedReader(reader)
+    return reader if "b" in mode else io.TextIOWrapper(reader, encoding=encoding)
+
+
+def index_zstd_frames(path):
+    """
+    Returns the offset and the compressed size of every frame of a zstd file. Only the frame and block headers are
+    read, nothing is decompressed. Skippable frames, e.g. the seek table of the zstd seekable format, are left out.
+    Raises a ValueError if the file is truncated or no zstd file.
+    """
+    frames = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as inf:
+        start = 0
+        while start < size:
+            inf.seek(start)
+            # 18 bytes is the maximum size of a frame header
+            header = inf.read(18)
+            if int.from_bytes(header[:4], "little") & 0xFFFFFFF0 == 0x184D2A50:
+                start += 8 + int.from_bytes(header[4:8], "little")
+                continue
+            try:
+                position = start + zstandard.frame_header_size(header)
+                has_checksum = zstandard.get_frame_parameters(header).has_checksum
+            except zstandard.ZstdError as e:
+                raise ValueError(f"{path} has no valid zstd frame header at byte {start}.") from e
+            while True:
+                inf.seek(position)
+                block_header = inf.read(3)
+                if len(block_header) < 3:
+                    raise ValueError(f"{path} is truncated in the zstd frame at byte {start}.")
+                block = int.from_bytes(block_header, "little")
+                # the size of RLE blocks is the size of their decompressed data, they consist of a single byte
+                position += 3 + (1 if (block >> 1) & 3 == 1 else block >> 3)
+                if block & 1:
+                    break
+            if has_checksum:
+                position += 4
+            if position > size:
+                raise ValueError(f"{path} is truncated in the zstd frame at byte {start}.")
+            frames.append((start, position - start))
+            start = position
+    return frames
+
+
+def get_byte_ranges(path, range_bytes):
+    """
+    Splits path into ranges of about range_bytes bytes that are read independently with read_byte_range, as
+    (start, end, whether it is the first range). Plain files are split anywhere and zstd files between frames.
+    gzip members can't be found without decompressing the file, so gzip files are a single range.
+    """
+    codec = detect_codec(path)
+    size = os.path.getsize(path)
+    if codec == "plain":
+        return [(start, min(start + range_bytes, size), start == 0) for start in range(0, size, range_bytes)]
+    if codec == "gzip":
+        return [(0, size, True)]
+    ranges, start = [], None
+    for frame_start, frame_size in index_zstd_frames(path):
+        if start is None:
+            start = frame_start
+        if frame_start + frame_size - start >= range_bytes:
+            ranges.append((start, frame_start + frame_size, not ranges))
+            start = None
+    if start is not None:
+        ranges.append((start, size, not ranges))
+    return ranges
+
+
+def read_byte_range(path, start, end, first=True):
+    """
+    Returns the lines of a byte range of get_byte_ranges as (frame, offset of the first line, lines).
+    The offset is in the data decompressed from byte frame of the file on, which is the start of the range for
+    zstd files and 0 otherwise. Like Hadoop's LineRecordReader, every range but the first drops its first line,
+    which belongs to the previous range, and every range reads on to the first line break past its end, so
+    a range ending exactly after a line break reads one more line. Each line is thus read by exactly one range.
+    """
+    codec = detect_codec(path)
+    if codec == "gzip":
+        # gzip files are a single range, which can only be read as a whole
+        with open_input(path, "rb") as inp:
+            return 0, 0, inp.readlines()
+    frame = start if codec == "zstd" else 0
+    with open_input(path, "rb", start, end) as inp:
+        skipped = b"" if first else inp.readline()
+        if not first and not skipped.endswith(b"\n"):
+            # no line break in the range, its only line belongs to the previous range
+            return frame, start - frame + len(skipped), []
+        lines = inp.readlines()
+    if not lines or lines[-1].endswith(b"\n"):
+        # the line starting right at the end belongs to this range, unless the file ends there
+        with open_input(path, "rb", end) as inp:
+            line = inp.readline()
+        if line:
+            lines.append(line)
+    else:
+        with open_input(path, "rb", end) as inp:
+            lines[-1] += inp.readline()
+    return frame, start - frame + len(skipped), lines
+
+
+# part files written by the workers end in .part<chunk number>
+PART_SUFFIX = re.compile(r"\.part\d+$")
+
+
+def merge_part_files(part_files):
+    """
+    Concatenates the part files in the given order into the files named like them without the part suffix and
+    deletes them. Concatenated gzip members and zstd frames are valid gzip and zstd files themselves,
+    so compressed part files are merged without recompressing them.
+    """
+    parts_by_outfile = collections.defaultdict(list)
+    for part_file in part_files:
+        parts_by_outfile[PART_SUFFIX.sub("", part_file)].append(part_file)
+    for outfile, parts in parts_by_outfile.items():
+        with open(f"{outfile}.tmp", "wb") as outf:
+            for part in parts:
+                with open(part, "rb") as inf:
+                    shutil.copyfileobj(inf, outf, OUTPUT_BUFFER_SIZE)
+        os.replace(f"{outfile}.tmp", outfile)
+        for part in parts:
+            os.remove(part)
+
+
+class BackgroundWriter:
+    """
+    Runs write tasks in order in a dedicated thread, so that serializing and writing the results of one batch
+    overlaps with matching the next one. At most max_queued tasks wait in the queue, submit blocks beyond that.
+    An error of a task is raised by the next submit or by close, the remaining tasks are skipped.
+    """
+
+    def __init__(self, max_queued=16, metrics=None):
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.metrics = metrics
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            if self.error:
+                self.queue.task_done()
+                continue
+            func, args = task
+            start = time.perf_counter()
+            try:
+                func(*args)
+            except BaseException as e:
+                self.error = e
+            if self.metrics:
+                self.metrics.add_seconds("write", time.perf_counter() - start)
+            self.queue.task_done()
+
+    def submit(self, func, *args):
+        if self.error:
+            raise self.error
+        self.queue.put((func, args))
+
+    def wait(self):
+        """Waits until all submitted tasks are done."""
+        self.queue.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            # don't hide the original error behind an error of a write task
+            self.queue.put(None)
+            self.thread.join()
+        else:
+            self.close()
+
+
+def timed(iterable, seconds, stage):
+    """Yields from iterable, adding the time spent producing the items to seconds[stage]."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            seconds[stage] += time.perf_counter() - start
+        yield item
+
+
+class Metrics:
+    """
+    Aggregates the stage timings and counts reported with the result of every chunk and exports them
+    every interval seconds to path: as one json line per export or, if path ends with .prom,
+    as a Prometheus textfile that is replaced on every export.
+    Results of the workers are dicts of counts (docs, tokens, matches, ...) plus "seconds" per stage
+    and the "pid" of the worker, whose busy time gives its utilization.
+    """
+
+    def __init__(self, path=None, interval=30.0, name="frequencies"):
+        self.path = path
+        self.interval = interval
+        self.name = name
+        self.start = self.last_export = time.time()
+        self.counts = collections.Counter()
+        self.seconds = collections.Counter()
+        self.worker_seconds = collections.Counter()
+        self.queues = {}
+
+    def add(self, stats):
+        for key, value in stats.items():
+            if key == "seconds":
+                self.seconds.update(value)
+                self.worker_seconds[stats["pid"]] += sum(value.values())
+            elif key != "pid":
+                self.counts[key] += value
+
+    def add_seconds(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def set_queue(self, name, depth):
+        self.queues[name] = depth
+
+    def snapshot(self):
+        now = time.time()
+        elapsed = max(now - self.start, 1e-6)
+        counts, seconds, worker_seconds = dict(self.counts), dict(self.seconds), dict(self.worker_seconds)
+        return {
+            "time": now,
+            "elapsed_s": elapsed,
+            "counts": counts,
+            "per_s": {key: count / elapsed for key, count in counts.items()},
+            "stage_s": seconds,
+            "queues": dict(self.queues),
+            "worker_utilization": {str(pid): busy / elapsed for pid, busy in worker_seconds.items()},
+        }
+
+    def maybe_export(self):
+        if self.path and time.time() - self.last_export >= self.interval:
+            self.export()
+
+    def export(self):
+        self.last_export = time.time()
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        if not self.path.endswith(".prom"):
+            with open(self.path, "a", encoding="utf-8") as outf:
+                outf.write(f"{json.dumps(snapshot)}\n")
+            return
+        prefix = f"gnr_{self.name}"
+        lines = [f"{prefix}_elapsed_seconds {snapshot['elapsed_s']}"]
+        lines += [f'{prefix}_total{{counter="{key}"}} {count}' for key, count in snapshot["counts"].items()]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{stage}"}} {s}' for stage, s in snapshot["stage_s"].items()]
+        lines += [f'{prefix}_queue_depth{{queue="{name}"}} {depth}' for name, depth in snapshot["queues"].items()]
+        lines += [
+            f'{prefix}_worker_utilization{{pid="{pid}"}} {utilization}'
+            for pid, utilization in snapshot["worker_utilization"].items()
+        ]
+        # written to a temporary file first, so that the textfile collector never reads a partial file
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as outf:
+            outf.write("\n".join(lines) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def log_summary(self):
+        snapshot = self.snapshot()
+        rates = ", ".join(f"{rate:.1f} {key}/s" for key, rate in snapshot["per_s"].items())
+        stages = ", ".join(f"{stage} {s:.1f}s" for stage, s in snapshot["stage_s"].items())
+        logger.info(f"Throughput: {rates}. Time per stage: {stages}.")
+
+
+class Profiler:
+    """
+    cProfile of a process, enabled between start and stop or while it is used as a context manager and dumped to
+    outdir/<role>.<pid>.prof on every stop. Pool workers are terminated without running exit handlers,
+    so their profiles are dumped after every task. merge_profiles merges the profiles of all processes.
+    The components of the spaCy models are wrapped once a profiler is started, see ProfiledComponent.
+    """
+
+    # the enabled profiler of the process, which forked pool workers inherit
+    active = None
+
+    def __init__(self, outdir, role="main"):
+        self.path = os.path.join(outdir, f"{role}.{os.getpid()}.prof")
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        global _PROFILE_COMPONENTS
+        _PROFILE_COMPONENTS = True
+        for model in _SPACY_MODELS.values():
+            profile_components(model)
+        Profiler.active = self
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        self.profile.disable()
+        Profiler.active = None
+        self.profile.dump_stats(f"{self.path}.tmp")
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @staticmethod
+    def clear(outdir):
+        """Creates outdir and removes the profiles of previous runs from it."""
+        os.makedirs(outdir, exist_ok=True)
+        for path in Path(outdir).glob("*.prof"):
+            os.remove(path)
+
+
+# categories of the profile report, given by the innermost function on the call path matching the pattern,
+# except for imports, which include everything that is run on importing a module
+PROFILE_CATEGORIES = [
+    ("import", re.compile(r"importlib")),
+    ("matcher", re.compile(r"spacy/matcher/|_get_segments_by_matches|_sort_out_common_segments|_single_out_matches")),
+    ("prefilter", re.compile(r"is_candidate")),
+    ("spacy:tokenizer", re.compile(r"spacy/tokenizer")),
+    ("spacy:{}", re.compile(r"spacy_component_(\w+)")),
+    ("io", re.compile(r"zstd|gzip|_compression|zlib|json|_io\.|_csv|open_input|open_output|decode_oscar")),
+]
+
+
+def get_profile_category(path):
+    """Returns the category of a call path, functions of spaCy without a category of their own count as spacy."""
+    category = None
+    for filename, _, name in path:
+        for pattern_category, pattern in PROFILE_CATEGORIES:
+            match = pattern.search(f"{filename}:{name}")
+            if match:
+                category = pattern_category.format(*match.groups())
+                if category == "import":
+                    return category
+                break
+        else:
+            if category is None and "spacy/" in filename:
+                category = "spacy"
+    return category or "other"
+
+
+def collapse_stats(stats, min_seconds=1e-4):
+    """
+    Returns the time spent per call path of pstats stats. cProfile only records callers and callees, so the time
+    of a function is distributed over the paths leading to it in proportion to the time of each caller's calls,
+    the way flame graphs are usually made from cProfile output. Paths taking less than min_seconds are dropped.
+    """
+    callees = collections.defaultdict(list)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees[caller].append((func, caller_stats[3]))
+    paths = collections.Counter()
+    # (path, share of the total time of the last function of path spent on this path)
+    todo = [((func,), 1.0) for func, (_, _, _, _, callers) in stats.items() if not callers]
+    while todo:
+        path, share = todo.pop()
+        func = path[-1]
+        paths[path] += share * stats[func][2]
+        for callee, seconds in callees[func]:
+            # recursive calls are counted with the outermost call
+            if callee in path or share * seconds < min_seconds:
+                continue
+            todo.append((path + (callee,), share * seconds / stats[callee][3]))
+    return paths
+
+
+def format_profile_function(func):
+    filename, line, name = func
+    # built-in functions have no file
+    label = name if filename == "~" else f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(";", ",")
+
+
+def merge_profiles(profile_dir, top=40):
+    """
+    Merges the profiles written by the Profilers of all processes to profile_dir into profile.prof (pstats),
+    profile.collapsed (collapsed stacks for flamegraph.pl or speedscope, rooted at the main process and
+    the workers) and profile.txt (time per category of the main process and the workers and the functions
+    with the highest cumulative time).
+    """
+    report = io.StringIO()
+    merged = None
+    collapsed = collections.Counter()
+    for role in ["main", "worker"]:
+        files = sorted(str(path) for path in Path(profile_dir).glob(f"{role}.*.prof"))
+        if not files:
+            continue
+        stats = pstats.Stats(*files, stream=report)
+        categories = collections.Counter()
+        for path, seconds in collapse_stats(stats.stats).items():
+            categories[get_profile_category(path)] += seconds
+            collapsed[";".join([role] + [format_profile_function(func) for func in path])] += seconds
+        total = max(sum(categories.values()), 1e-9)
+        report.write(f"Time per category of the {role} process{'es' if role == 'worker' else ''} ({len(files)}):\n")
+        for category, seconds in categories.most_common():
+            report.write(f"{category:<30}{seconds:>12.2f}s{seconds / total:>8.1%}\n")
+        report.write("\n")
+        merged = stats if merged is None else merged.add(stats)
+    if merged is None:
+        logger.warning(f"No profiles found in {profile_dir}.")
+        return
+    merged.dump_stats(os.path.join(profile_dir, "profile.prof"))
+    with open(os.path.join(profile_dir, "profile.collapsed"), "w", encoding="utf-8") as outf:
+        # flamegraph.pl expects integer sample counts, the times are written in microseconds
+        outf.writelines(f"{path} {round(seconds * 1e6)}\n" for path, seconds in sorted(collapsed.items()) if seconds >= 1e-6)
+    merged.sort_stats("cumulative").print_stats(top)
+    with open(os.path.join(profile_dir, "profile.txt"), "w", encoding="utf-8") as outf:
+        outf.write(report.getvalue())
+    logger.info(f"Wrote merged profile to {profile_dir}.")
+
+
+def strip_codec_suffix(path):
+    for suffix in CODEC_SUFFIXES.values():
+        if suffix and str(path).endswith(suffix):
+            return str(path)[: -len(suffix)]
+    return str(path)
 
 
 class Terminology:
@@ -42,19 +742,128 @@ class Terminology:
         "plural_gender_neutral",
     ]
 
-    def __init__(self, terminology_file):
+    # increase when the format of the cached terms or patterns changes
+    CACHE_VERSION = 2
+
+    def __init__(self, terminology_file, cache_dir=None):
         self._current_id = -1
         self.terms = []
-        self._terms_by_string = {}
-        self._read_terminology_from_file(terminology_file)
-        self.terms_by_id = {term.id: term for term in self.terms}
+        # terms by (term, gender, number, type) to find already existing terms while reading
+        self._terms_by_key = {}
+        self.cache_dir = cache_dir
+        # pattern docs of all terms per spaCy vocab, see get_patterns
+        self._patterns = {}
+        with open(terminology_file, "rb") as term_file:
+            self.source_hash = hashlib.sha256(term_file.read()).hexdigest()
+        if not self._load_cached_terms():
+            self._read_terminology_from_file(terminology_file)
+            self._cache_terms()
+        self._build_views()
+        # term counts indexed by term id, the ids are assigned consecutively from 0
+        self.count_array = np.zeros(len(self.terms), dtype=np.int64)
 
     def __getstate__(self):
         state = self.__dict__.copy()
+        # spaCy docs are bound to the vocab of the process, workers load them again from the cache
+        state["_patterns"] = {}
+        # only needed while reading, the views are rebuilt from the terms to keep the pickled state small
+        del state["_terms_by_key"]
+        del state["terms_by_id"]
+        del state["_views"]
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._terms_by_key = {}
+        self._build_views()
+
+    def _build_views(self):
+        """
+        Index the terms by id and by gender once the terminology is complete, so that the views don't have
+        to be rebuilt on every access. The terminology isn't changed after reading, except for the counts.
+        """
+        for term in self.terms:
+            term.freeze()
+        self.terms_by_id = {term.id: term for term in self.terms}
+        self._views = {
+            "gendered": {term.id: term for term in self.terms if term.gender == "m" or term.gender == "f"},
+            "masculine": {term.id: term for term in self.terms if term.gender == "m"},
+            "feminine": {term.id: term for term in self.terms if term.gender == "f"},
+            "neutral": {term.id: term for term in self.terms if term.gender == "neut"},
+        }
+        from spacy.strings import hash_string
+
+        # the matchers use the hashed term ids as match ids, sorted to look up the term ids with searchsorted
+        match_ids = np.array([hash_string(str(term.id)) for term in self.terms], dtype=np.uint64)
+        order = np.argsort(match_ids)
+        self._sorted_match_ids = match_ids[order]
+        self._term_ids_by_match_id = np.array([term.id for term in self.terms], dtype=np.int64)[order]
+
+    def _get_cache_path(self, suffix):
+        return os.path.join(self.cache_dir, f"{self.source_hash}.v{Terminology.CACHE_VERSION}.{suffix}")
+
+    def _load_cached_terms(self):
+        if not self.cache_dir or not os.path.exists(self._get_cache_path("terms.json")):
+            return False
+        with open(self._get_cache_path("terms.json"), "r", encoding="utf-8") as cache_file:
+            for record in json.load(cache_file):
+                term_id, term_string, gender, number, neut_type, correspondences, f_correspondences, m_correspondences = record
+                term = Term(term_id, term_string, gender, number, neut_type)
+                term.correspondences = correspondences
+                term.f_correspondences = f_correspondences
+                term.m_correspondences = m_correspondences
+                self.terms.append(term)
+                self._terms_by_key[(term.term, term.gender, term.number, term.type)] = term
+                self._current_id = max(self._current_id, term.id)
+        logger.info(f"Loaded terminology from cache {self._get_cache_path('terms.json')}.")
+        return True
+
+    def _cache_terms(self):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self._get_cache_path("terms.json")
+        records = [
+            [t.id, t.term, t.gender, t.number, t.type, list(t.correspondences), list(t.f_correspondences), list(t.m_correspondences)]
+            for t in self.terms
+        ]
+        # several runs can share a cache directory, so the file is only visible once it is complete
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(records, cache_file)
+        os.replace(tmp_path, cache_path)
+
+    def get_patterns(self, term_ids, model):
+        """
+        Returns the spaCy docs of the given terms to be added as patterns to a PhraseMatcher.
+        The docs of all terms are created once per model. With a cache directory, they are stored as a DocBin
+        keyed by the terminology file, the spaCy version, the model and its enabled components, so that
+        later runs and spawned workers don't need to run the terms through spaCy again.
+        """
+        if id(model.vocab) not in self._patterns:
+            self._patterns[id(model.vocab)] = self._load_patterns(model)
+        patterns = self._patterns[id(model.vocab)]
+        return [patterns[i] for i in term_ids]
+
+    def _load_patterns(self, model):
+        import spacy
+        from spacy.tokens import DocBin
+
+        model_key = hashlib.sha256(
+            f"{spacy.__version__}-{model.meta['lang']}_{model.meta['name']}-{model.meta['version']}-{'+'.join(model.pipe_names)}".encode("utf-8")
+        ).hexdigest()[:16]
+        cache_path = self._get_cache_path(f"{model_key}.patterns.spacy") if self.cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            docs = list(DocBin().from_disk(cache_path).get_docs(model.vocab))
+            logger.info(f"Loaded term patterns from cache {cache_path}.")
+        else:
+            docs = list(model.pipe(term.term for term in self.terms))
+            if cache_path:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+                DocBin(docs=docs).to_disk(tmp_path)
+                os.replace(tmp_path, cache_path)
+        return {term.id: doc for term, doc in zip(self.terms, docs)}
 
     def _read_terminology_from_file(self, terminology_file):
         with open(terminology_file, "r", encoding="utf-8") as term_file:
@@ -85,10 +894,7 @@ class Terminology:
                         term = Term(term_id, term_string, gender, number, neut_type)
                         self.terms.append(term)
                         # to keep track of already existing terms
-                        if self._terms_by_string.get(term.term):
-                            self._terms_by_string[term.term].append(term)
-                        else:
-                            self._terms_by_string[term.term] = [term]
+                        self._terms_by_key[(term.term, term.gender, term.number, term.type)] = term
                     else:
                         term = self._get_term(term_string, gender, number, neut_type)
 
@@ -121,22 +927,10 @@ class Terminology:
             entry["plural_gender_neutral"].add_correspondence(entry.get("plural_feminine"), gender="f")
 
     def _term_exists(self, term, gender, number, type):
-        existing_terms = self._terms_by_string.get(term)
-        if not existing_terms:
-            return False
-        for t in existing_terms:
-            if t.gender == gender and t.number == number and t.type == type:
-                return True
-        return False
+        return (term, gender, number, type) in self._terms_by_key
 
     def _get_term(self, term, gender, number, type):
-        existing_terms = self._terms_by_string.get(term)
-        if not existing_terms:
-            return None
-        for t in existing_terms:
-            if t.gender == gender and t.number == number and t.type == type:
-                return t
-        return None
+        return self._terms_by_key.get((term, gender, number, type))
 
     def _get_new_id(self):
         self._current_id += 1
@@ -158,34 +952,24 @@ class Terminology:
 
     @property
     def counts(self):
-        counts = {term.id: term.count for term in self.terms}
+        counts = {term.id: int(self.count_array[term.id]) for term in self.terms}
         return counts
 
     @property
     def gendered_terms(self):
-        gendered_terms = {
-            term.id: term for term in self.terms if term.gender == "m" or term.gender == "f"
-        }
-        return gendered_terms
+        return self._views["gendered"]
 
     @property
     def masculine_terms(self):
-        m_terms = {
-            term.id: term for term in self.terms if term.gender == "m"
-        }
-        return m_terms
+        return self._views["masculine"]
 
     @property
     def feminine_terms(self):
-        f_terms = {
-            term.id: term for term in self.terms if term.gender == "f"
-        }
-        return f_terms
+        return self._views["feminine"]
 
     @property
     def neutral_terms(self):
-        neutral_terms = {term.id: term for term in self.terms if term.gender == "neut"}
-        return neutral_terms
+        return self._views["neutral"]
 
     @property
     def gendered_terms_with_correspondences(self):
@@ -198,12 +982,21 @@ class Terminology:
         ...
 
     def update_count(self, index, count):
-        term = self.terms_by_id.get(index)
-        if term:
-            term.count += count
+        if index in self.terms_by_id:
+            self.count_array[index] += count
+
+    def add_counts(self, counts):
+        self.count_array += counts
+
+    def count_matches(self, match_ids):
+        """Returns a count vector indexed by term id for the match ids returned by a PhraseMatcher."""
+        match_ids = np.asarray(match_ids, dtype=np.uint64)
+        term_ids = self._term_ids_by_match_id[np.searchsorted(self._sorted_match_ids, match_ids)]
+        return np.bincount(term_ids, minlength=len(self.terms))
 
     def write_counts(self, count_outpath):
-        with open(count_outpath, "w", encoding="utf-8", newline="") as outf:
+        # write to a temporary file first so that an interrupted run never leaves a partial counts file
+        with open(f"{count_outpath}.tmp", "w", encoding="utf-8", newline="") as outf:
             writer = csv.writer(outf, delimiter=",")
             writer.writerow(
                 [
@@ -217,28 +1010,31 @@ class Terminology:
             )
             for term in self.terms:
                 correspondences = ";".join([self.terms_by_id[i].term for i in term.correspondences])
-                row = [term.type, term.number, term.gender, term.term, term.count, correspondences]
+                row = [term.type, term.number, term.gender, term.term, int(self.count_array[term.id]), correspondences]
                 writer.writerow(row)
+        os.replace(f"{count_outpath}.tmp", count_outpath)
 
 
 class Term:
-    def __init__(self, id, term, gender, number, type, count=0):
+    # terms are pickled into every worker, slots keep them small
+    __slots__ = ["id", "term", "gender", "number", "type", "correspondences", "f_correspondences", "m_correspondences"]
+
+    def __init__(self, id, term, gender, number, type):
         self.id = id
         self.term = term
         self.gender = gender
         self.number = number
         self.type = type
-        self.count = count
         self.correspondences = []
         self.f_correspondences = []
         self.m_correspondences = []
 
     def __getstate__(self):
-        state = self.__dict__.copy()
-        return state
+        return tuple(getattr(self, slot) for slot in Term.__slots__)
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        for slot, value in zip(Term.__slots__, state):
+            setattr(self, slot, value)
 
     def __repr__(self):
         return self.term
@@ -253,254 +1049,1163 @@ class Term:
             else:
                 self.correspondences.append(term.id)
 
-    def increase_count(self, n):
-        self.count += n
+    def freeze(self):
+        # correspondences don't change after reading the terminology
+        self.correspondences = tuple(self.correspondences)
+        self.f_correspondences = tuple(self.f_correspondences)
+        self.m_correspondences = tuple(self.m_correspondences)
+
+
+class CountConfig:
+    """
+    A further terminology and match level that TermMatcher and TermCounter count on the same spaCy docs as their own,
+    so that comparing terminologies or match levels doesn't need another tagging and lemmatizing pass over the corpus.
+    The counts are kept in the terminology and written to count_outpath.
+    """
+
+    def __init__(self, terminology, match_level, count_outpath, prefilter=False):
+        self.terminology = terminology
+        self.match_level = match_level
+        self.count_outpath = count_outpath
+        self.matcher = get_phrase_matcher(self.terminology, self.terminology.terms_by_id, self.match_level)
+        self.prefilter = TermPrefilter(self.terminology, self.terminology.terms_by_id, match_level) if prefilter else None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["matcher"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.matcher = get_phrase_matcher(self.terminology, self.terminology.terms_by_id, self.match_level)
+
+    def write_counts(self):
+        self.terminology.write_counts(self.count_outpath)
 
 
 class TermMatcher:
-    def __init__(self, oscar_path, terminology, match_level, unmatched_only=False):
+    def __init__(
+        self,
+        oscar_path,
+        terminology,
+        match_level,
+        unmatched_only=False,
+        prefilter=False,
+        shard=None,
+        max_window_chars=MAX_WINDOW_CHARS,
+        batch_chars=BATCH_CHARS,
+        doc_codec="gzip",
+        segment_codec="plain",
+        compression_level=None,
+        compression_threads=1,
+        metrics=None,
+        provenance=False,
+        profile_dir=None,
+        configs=None,
+        quota=None,
+        metadata_filter=None,
+    ):
         self.oscar_path = oscar_path
+        self.quota = quota
+        self.metadata_filter = metadata_filter
+        self.profile_dir = profile_dir
+        self.configs = configs or []
+        self.shard = shard
+        self.max_window_chars = max_window_chars
+        self.batch_chars = batch_chars
+        self.doc_codec = doc_codec
+        self.segment_codec = segment_codec
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.provenance = provenance
         self.terminology = terminology
         self.match_level = match_level
         self.unmatched_only = unmatched_only
-        self.matcher = self._get_matcher(self.terminology.terms_by_id)
-        self.neut_matcher = self._get_matcher(self.terminology.neutral_terms)
-        self.gendered_matcher = self._get_matcher(self.terminology.gendered_terms)
-
-    def _get_matcher(self, terms):
-        # create spacy docs for terms
-        # TODO: should stopwords be removed?
-        terms = {i: term.term for i, term in terms.items() if term.term not in DE_STOPWORDS}
-        prep_terms = list(SPACY_MODEL.pipe(terms.values()))
-        # initialize PhraseMatcher
-        matcher = PhraseMatcher(prep_terms[0].vocab, attr=self.match_level)
-        for term_id, term in zip(terms.keys(), prep_terms):
-            match_id = str(term_id)
-            matcher.add(match_id, [term])
-
-        return matcher
+        self.handle = uuid.uuid4().hex
+        self.matcher = get_phrase_matcher(self.terminology, self.terminology.terms_by_id, self.match_level)
+        # unmatched segments are extracted from all documents, so none can be skipped
+        if prefilter and unmatched_only:
+            logger.info("The prefilter is not used when extracting unmatched segments.")
+            prefilter = None
+        self.prefilter = TermPrefilter(self.terminology, self.terminology.terms_by_id, match_level) if prefilter else None
+        self.prefilter_stats = collections.Counter()
+        self.metrics = metrics or Metrics()
+        # maps the hashed match ids of the matcher to the terms to look up their gender
+        self.terms_by_match_id = {
+            get_spacy_model().vocab.strings.add(str(i)): term for i, term in self.terminology.terms_by_id.items()
+        }
 
     # needed for serialization for multiprocessing
     def __getstate__(self):
         state = self.__dict__.copy()
         # PhraseMatchers can't be serialized, therefore have to be deleted
         del state["matcher"]
-        del state["neut_matcher"]
-        del state["gendered_matcher"]
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        # recreate PhraseMatchers
-        self.matcher = self._get_matcher(self.terminology.terms_by_id)
-        self.neut_matcher = self._get_matcher(self.terminology.neutral_terms)
-        self.gendered_matcher = self._get_matcher(self.terminology.gendered_terms)
+        # recreate PhraseMatcher
+        self.matcher = get_phrase_matcher(self.terminology, self.terminology.terms_by_id, self.match_level)
 
-    def _search_oscar_files(self, outpath, inspection=False, nr_cpus=None):
+    def _get_oscar_files(self):
         oscar_files = index_files(self.oscar_path, suffixes=["jsonl", "zst", "gz"])
-        num_cpus = nr_cpus or (cpu_count() // 3 * 2)
+        if self.shard:
+            shard, num_shards = self.shard
+            oscar_files = shard_files(oscar_files, shard, num_shards)
+            logger.info(f"Processing shard {shard}/{num_shards}.")
+        return oscar_files
+
+    def _remove_stale_outputs(self, outpath, manifest):
+        """
+        Removes the temporary and part files a killed run left behind for the OSCAR files that aren't completed.
+        Only the files of this shard are touched, other shards can be running at the same time.
+        """
+        stems = [Path(inf).stem.replace(".jsonl", "") for inf in self._get_oscar_files() if not manifest.is_completed(inf)]
+        for path in Path(outpath).glob("*/*.extracted.*"):
+            if not (path.name.endswith(".tmp") or PART_SUFFIX.search(path.name)):
+                continue
+            name = path.name.split(".extracted.", 1)[1]
+            if any(name.startswith(f"{stem}.") for stem in stems):
+                logger.info(f"Removing {path} left behind by a previous run.")
+                os.remove(path)
+
+    def _read_oscar_file(self, inf, decode=True):
+        """
+        Read all OSCAR documents of a file, as OscarRecords or, without decode, as raw lines.
+        Returns None if the file can't be decoded.
+        """
+        seconds = collections.Counter()
+        start = time.perf_counter()
+        try:
+            # the codec is detected by the magic bytes, unmatched segments are usually extracted from gzipped files
+            with open_input(inf, "rb") as inp:
+                lines = timed(inp, seconds, "decompress")
+                data = decode_oscar_lines(lines) if decode else list(lines)
+        except:
+            return None
+        seconds["parse"] = time.perf_counter() - start - seconds["decompress"]
+        if len(data) == 0:
+            return None
+        if decode and self.metadata_filter:
+            # documents are dropped before they are sent to the workers
+            start = time.perf_counter()
+            data, _ = self.metadata_filter.filter(data)
+            seconds["metadata_filter"] = time.perf_counter() - start
+        self.metrics.seconds.update(seconds)
+        return data
+
+    @staticmethod
+    def _generate_chunks(data, chunk_size):
+        for i in range(0, len(data), chunk_size):
+            yield data[i : i + chunk_size]
+
+    def _update_counts(self, match_counts, config_counts=()):
+        self.terminology.add_counts(match_counts)
+        for config, counts in zip(self.configs, config_counts):
+            config.terminology.add_counts(counts)
+
+    def _search_oscar_files(self, outpath, inspection=False, nr_cpus=None, manifest=None, dedup=None):
+        oscar_files = self._get_oscar_files()
+        num_cpus = nr_cpus or max(1, cpu_count() // 3 * 2)
         logger.info(f"Running on {num_cpus} CPUs")
         logger.info(f"Filtering {len(oscar_files)} files.")
-        pool = Pool(processes=(num_cpus))
+        pool = Pool(processes=(num_cpus), initializer=init_worker, initargs=(self,))
+        process_chunk = worker_task(self, "_process_chunk")
+        # results are written while the pool already matches the next file
+        background = BackgroundWriter(metrics=self.metrics)
         for inf in oscar_files:
+            if self._quota_filled(background):
+                break
+            if manifest and manifest.is_completed(inf):
+                self._skip_completed_file(inf, manifest)
+                continue
             logger.info(f"Starting processing {inf}...")
             start = time.time()
-            # extract unmatched segments to complement training data
-            if self.unmatched_only:
-                unmatched_outfile = f"{outpath}/unmatched/seg.unm.extracted.{inf.stem.replace('.jsonl', '')}.txt"
-
-                with gzip.open(inf, mode="rt") as inp, open(unmatched_outfile, mode="w", encoding="utf-8") as unm_outp:
-                    try:
-                        data = [json.loads(d) for d in inp]
-                        if len(data) == 0:
-                            continue
-                    except:
-                        continue
+            writer = self._new_writer(inf, outpath, inspection, dedup)
+            data = self._read_oscar_file(inf)
+            if data is None:
+                writer.close()
+                continue
 
-                    # divide data into chunks
-                    chunk_size = len(data) // (cpu_count() // 2)
-                    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+            # divide data into chunks
+            chunk_size = max(1, len(data) // max(1, cpu_count() // 2))
+            chunks = list(self._generate_chunks(data, chunk_size))
 
-                    # process chunks in parallel
-                    results = pool.map(self._process_chunk, chunks)
+            # process chunks in parallel
+            self.metrics.set_queue("in_flight", len(chunks))
+            results = pool.map(process_chunk, chunks)
 
-                    # aggregate and write results
-                    logger.info(f"Writing extracted data to files.")
-                    for _, _, _, _, _, unm_segs in results:
-                        for seg in unm_segs:
-                            seg = seg.replace("\n", " ")
-                            unm_outp.write(f"{seg}\n")
-            # normal filtering with terminology
-            else:
-                doc_outfile = f"{outpath}/doc/doc.extracted.{inf.stem}.gz"
-                neut_outfile = f"{outpath}/neutral/seg.neut.extracted.{inf.stem.replace('.jsonl', '')}.{'csv' if inspection else 'txt'}"
-                gen_outfile = f"{outpath}/gendered/seg.gen.extracted.{inf.stem.replace('.jsonl', '')}.{'csv' if inspection else 'txt'}"
-                both_outfile = f"{outpath}/both/seg.both.extracted.{inf.stem.replace('.jsonl', '')}.{'csv' if inspection else 'txt'}"
-                with open(inf, mode="rb") as inp, gzip.open(doc_outfile, mode="wb") as doc_outp, open(
-                    neut_outfile, mode="w", encoding="utf-8"
-                ) as neut_outp, open(gen_outfile, mode="w", encoding="utf-8") as gen_outp, open(
-                    both_outfile, mode="w", encoding="utf-8"
-                ) as com_outp:
-                    if inspection:
-                        neut_writer = csv.writer(neut_outp, delimiter=";")
-                        gen_writer = csv.writer(gen_outp, delimiter=";")
-                        com_writer = csv.writer(com_outp, delimiter=";")
-                    dctx = zstandard.ZstdDecompressor()
-                    stream_reader = dctx.stream_reader(inp)
-                    text_stream = io.TextIOWrapper(stream_reader, encoding="utf-8")
-                    try:
-                        data = [json.loads(d) for d in text_stream]
-                    except:
-                        continue
-                    # divide data into chunks
-                    chunk_size = len(data) // (cpu_count() // 2)
-                    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
-
-                    # process chunks in parallel
-                    results = pool.map(self._process_chunk, chunks)
-
-                    # aggregate and write results
-                    logger.info(f"Writing extracted data to files.")
-                    for match_counts, out_data, neut_segs, gen_segs, com_segs, _ in results:
-                        for i, count in match_counts.items():
-                            self.terminology.update_count(i, count)
-                        for doc in out_data:
-                            out = f"{json.dumps(doc)}\n".encode("utf-8")
-                            doc_outp.write(out)
-                        for matches, seg in neut_segs:
-                            seg = seg.replace("\n", " ")
-                            if inspection:
-                                neut_writer.writerow([",".join(matches), seg])
-                            else:
-                                neut_outp.write(f"{seg}\n")
-                        for matches, seg in gen_segs:
-                            seg = seg.replace("\n", " ")
-                            if inspection:
-                                gen_writer.writerow([",".join(matches), seg])
-                            else:
-                                gen_outp.write(f"{seg}\n")
-                        for matches, seg in com_segs:
-                            seg = seg.replace("\n", " ")
-                            if inspection:
-                                com_writer.writerow([",".join(matches), seg])
-                            else:
-                                com_outp.write(f"{seg}\n")
+            # aggregate and write results
+            logger.info(f"Matched {inf} after {time.time() - start}s, writing extracted data to files.")
+            for chunk, result in zip(chunks, results):
+                self._collect_result(writer, chunk, result, background)
+            self._finish_file(writer, manifest, background)
             del results
-
-            end = time.time()
-            logger.info(f"Done after {end - start}s!")
+        background.close()
         pool.close()
         pool.join()
+        self.metrics.export()
+
+    def _search_oscar_files_pipelined(
+        self,
+        outpath,
+        inspection=False,
+        nr_cpus=None,
+        chunk_size=1000,
+        max_in_flight=None,
+        manifest=None,
+        dedup=None,
+    ):
+        """
+        Process the OSCAR files as one continuous stream of chunks instead of one pool.map per file.
+        The next files are read and chunked while the chunks of the previous files are still matched.
+        At most max_in_flight chunks are submitted to the pool at any time, results are written in
+        submission order so that the output of each file keeps the order of the input documents.
+        """
+        oscar_files = self._get_oscar_files()
+        num_cpus = nr_cpus or max(1, cpu_count() // 3 * 2)
+        max_in_flight = max_in_flight or num_cpus * 2
+        logger.info(f"Running on {num_cpus} CPUs with at most {max_in_flight} chunks in flight")
+        logger.info(f"Filtering {len(oscar_files)} files.")
+        # holds (writer, chunk, async result) in submission order, a result of None marks the end of a file
+        pending = collections.deque()
+        process_chunk = worker_task(self, "_process_chunk")
+        with Pool(processes=num_cpus, initializer=init_worker, initargs=(self,)) as pool, BackgroundWriter(metrics=self.metrics) as background:
+            for inf in oscar_files:
+                if self._quota_filled(background):
+                    break
+                if manifest and manifest.is_completed(inf):
+                    self._skip_completed_file(inf, manifest)
+                    continue
+                logger.info(f"Reading {inf}...")
+                data = self._read_oscar_file(inf)
+                if data is None:
+                    continue
+                writer = self._new_writer(inf, outpath, inspection, dedup)
+                for chunk in self._generate_chunks(data, chunk_size):
+                    while len(pending) >= max_in_flight:
+                        self._write_next_result(pending, manifest, background)
+                    if self.quota and self.quota.is_full():
+                        break
+                    pending.append((writer, chunk, pool.apply_async(process_chunk, (chunk,))))
+                pending.append((writer, None, None))
+                del data
+            while pending:
+                self._write_next_result(pending, manifest, background)
+        self.metrics.export()
+
+    def _search_oscar_files_to_parts(
+        self,
+        outpath,
+        inspection=False,
+        nr_cpus=None,
+        chunk_size=1000,
+        max_in_flight=None,
+        manifest=None,
+        range_bytes=None,
+    ):
+        """
+        Like _search_oscar_files_pipelined, but the workers decode the raw lines of their chunks and write the extracted
+        data to part files themselves, only the counts and the names of the part files are sent back.
+        The part files of an OSCAR file are merged in the background once all its chunks are done.
+        With range_bytes, the main process doesn't read the files at all, but hands the workers byte ranges
+        of about range_bytes bytes of them to read and decompress themselves.
+        """
+        oscar_files = self._get_oscar_files()
+        num_cpus = nr_cpus or max(1, cpu_count() // 3 * 2)
+        max_in_flight = max_in_flight or num_cpus * 2
+        logger.info(f"Running on {num_cpus} CPUs with at most {max_in_flight} chunks in flight, writing part files")
+        logger.info(f"Filtering {len(oscar_files)} files.")
+        # holds (file, async result) in submission order, a result of None marks the end of a file
+        pending = collections.deque()
+        # counts and part files of the files with pending chunks
+        file_counts, file_parts = {}, collections.defaultdict(list)
+        process_chunk = worker_task(self, "_process_chunk_to_parts")
+        process_range = worker_task(self, "_process_range_to_parts")
+        with Pool(processes=num_cpus, initializer=init_worker, initargs=(self,)) as pool, BackgroundWriter(metrics=self.metrics) as background:
+            for inf in oscar_files:
+                if self._quota_filled(background):
+                    break
+                if manifest and manifest.is_completed(inf):
+                    self._skip_completed_file(inf, manifest)
+                    continue
+                if range_bytes:
+                    try:
+                        byte_ranges = get_byte_ranges(inf, range_bytes)
+                    except ValueError:
+                        # like _read_oscar_file, a file that can't be read is skipped
+                        logger.exception(f"Skipping {inf}, it can't be split into byte ranges.")
+                        continue
+                    logger.info(f"Splitting {inf} into {len(byte_ranges)} byte ranges...")
+                    file_counts[inf] = self._new_counts()
+                    for part, byte_range in enumerate(byte_ranges):
+                        while len(pending) >= max_in_flight:
+                            self._collect_parts(pending, file_counts, file_parts, manifest, background)
+                        if self.quota and self.quota.is_full():
+                            break
+                        task = (inf, part, byte_range, outpath, inspection)
+                        pending.append((inf, pool.apply_async(process_range, task)))
+                    pending.append((inf, None))
+                    continue
+                logger.info(f"Reading {inf}...")
+                lines = self._read_oscar_file(inf, decode=False)
+                if lines is None:
+                    continue
+                file_counts[inf] = self._new_counts()
+                # byte offset of the first line of each chunk in the decompressed file
+                offset = 0
+                for part, chunk in enumerate(self._generate_chunks(lines, chunk_size)):
+                    while len(pending) >= max_in_flight:
+                        self._collect_parts(pending, file_counts, file_parts, manifest, background)
+                    if self.quota and self.quota.is_full():
+                        break
+                    task = (inf, part, chunk, outpath, inspection, part * chunk_size, offset)
+                    pending.append((inf, pool.apply_async(process_chunk, task)))
+                    offset += sum(len(line) for line in chunk)
+                pending.append((inf, None))
+                del lines
+            while pending:
+                self._collect_parts(pending, file_counts, file_parts, manifest, background)
+        self.metrics.export()
+
+    def _collect_parts(self, pending, file_counts, file_parts, manifest, background):
+        self.metrics.set_queue("in_flight", len(pending))
+        inf, async_result = pending.popleft()
+        if async_result is None:
+            counts, part_files = file_counts.pop(inf), file_parts.pop(inf, [])
+            if counts is None:
+                # like _read_oscar_file, a file with a chunk that can't be decoded is skipped as a whole
+                logger.warning(f"Skipping {inf}, it can't be decoded.")
+                for part_file in part_files:
+                    os.remove(part_file)
+                return
+            # the counts of a file are only added once all its chunks are decoded
+            if not self.unmatched_only:
+                self._update_counts(counts[0], counts[1:])
+            background.submit(self._merge_file, inf, part_files, counts, manifest)
+            return
+        match_counts, config_counts, part_files, stats = async_result.get()
+        file_parts[inf].extend(part_files)
+        if match_counts is None:
+            file_counts[inf] = None
+            return
+        if not self.unmatched_only and file_counts[inf] is not None:
+            for counts, chunk_counts in zip(file_counts[inf], [match_counts, *config_counts]):
+                counts += chunk_counts
+        filter_stats = stats.pop("metadata_filter")
+        if filter_stats:
+            self.metadata_filter.add_stats(filter_stats)
+        # documents skipped because the quotas were filled don't count towards the prefilter skip rate
+        self.prefilter_stats.update(docs=stats["docs"] - stats["quota_skipped"], skipped=stats["skipped"])
+        self.metrics.add(stats)
+        self.metrics.set_queue("write", background.queue.qsize())
+        self.metrics.maybe_export()
 
-    def _process_chunk(self, data):
-        match_counts = {i: 0 for i in self.terminology.terms_by_id.keys()}
-        out_data, neutral_segs, gendered_segs, common_segs, unmatched_segs = [], [], [], [], []
-
-        for d in data:
-            if len(d["content"]) > SPACY_MODEL.max_length:
-                SPACY_MODEL.max_length = len(d["content"]) + 100
+    @staticmethod
+    def _merge_file(inf, part_files, counts, manifest=None):
+        merge_part_files(part_files)
+        if manifest:
+            manifest.add(inf, counts[0], counts[1:])
+        logger.info(f"Done with {inf}!")
+
+    def _new_counts(self):
+        """Returns zero count vectors of the terminology and of every config."""
+        terminologies = [self.terminology] + [config.terminology for config in self.configs]
+        return [np.zeros(len(terminology.terms), dtype=np.int64) for terminology in terminologies]
+
+    def _process_range_to_parts(self, inf, part, byte_range, outpath, inspection=False):
+        """Reads the lines of a byte range of inf in the worker and processes them like _process_chunk_to_parts."""
+        start = time.perf_counter()
+        try:
+            frame, offset, lines = read_byte_range(inf, *byte_range)
+        except Exception:
+            logger.exception(f"Can't read byte range {byte_range[0]}-{byte_range[1]} of {inf}.")
+            return None, None, [], None
+        decompress_seconds = time.perf_counter() - start
+        # the index of the first document of the range is only known after reading all previous ranges
+        result = self._process_chunk_to_parts(inf, part, lines, outpath, inspection, None, offset, frame)
+        if result[-1] is not None:
+            result[-1]["seconds"]["decompress"] = decompress_seconds
+        return result
+
+    def _process_chunk_to_parts(self, inf, part, lines, outpath, inspection=False, index=0, offset=0, frame=0):
+        """
+        Decodes and matches a chunk of raw lines of inf in the worker and writes the extracted data to part files.
+        The first line is the record index at byte offset of inf, see OscarRecord. Returns the counts, the names of
+        the part files and the stats, or no counts, part files and stats if the chunk can't be decoded.
+        """
+        start = time.perf_counter()
+        try:
+            data = decode_oscar_lines(lines, index, offset, frame)
+        except Exception:
+            logger.exception(f"Can't decode chunk {part} of {inf}.")
+            return None, None, [], None
+        parse_seconds = time.perf_counter() - start
+        # the main process never decodes the documents, so they are filtered right after decoding them
+        filter_stats, filter_seconds = None, 0.0
+        if self.metadata_filter:
+            start = time.perf_counter()
+            data, filter_stats = self.metadata_filter.filter(data)
+            filter_seconds = time.perf_counter() - start
+        result = self._process_chunk(data)
+        stats = result[-1]
+        stats["metadata_filter"] = filter_stats
+        stats["seconds"]["metadata_filter"] = filter_seconds
+        start = time.perf_counter()
+        writer = self._new_writer(inf, outpath, inspection, part=part)
+        writer.write(result, data)
+        writer.close()
+        stats["seconds"]["parse"] = parse_seconds
+        stats["seconds"]["write"] = time.perf_counter() - start
+        return result[0], result[-2], writer.outfiles, stats
+
+    def _new_writer(self, inf, outpath, inspection=False, dedup=None, part=None):
+        return ExtractionWriter(
+            inf,
+            outpath,
+            inspection,
+            self.unmatched_only,
+            self._new_counts(),
+            dedup=dedup,
+            part=part,
+            doc_codec=self.doc_codec,
+            segment_codec=self.segment_codec,
+            compression_level=self.compression_level,
+            compression_threads=self.compression_threads,
+            provenance=self.provenance,
+            quota=self.quota,
+        )
+
+    def _write_next_result(self, pending, manifest, background):
+        self.metrics.set_queue("in_flight", len(pending))
+        writer, chunk, async_result = pending.popleft()
+        if async_result is None:
+            self._finish_file(writer, manifest, background)
+            return
+        self._collect_result(writer, chunk, async_result.get(), background)
+
+    def _collect_result(self, writer, chunk, result, background):
+        # counts are aggregated right away, only the outputs are written in the background
+        if not self.unmatched_only:
+            self._update_counts(result[0], result[-2])
+            for counts, chunk_counts in zip(writer.counts, [result[0], *result[-2]]):
+                counts += chunk_counts
+        stats = result[-1]
+        # documents skipped because the quotas were filled don't count towards the prefilter skip rate
+        self.prefilter_stats.update(docs=stats["docs"] - stats["quota_skipped"], skipped=stats["skipped"])
+        self.metrics.add(stats)
+        self.metrics.set_queue("write", background.queue.qsize())
+        self.metrics.maybe_export()
+        background.submit(writer.write, result, chunk)
+
+    def _finish_file(self, writer, manifest, background):
+        background.submit(self._close_writer, writer, manifest)
 
- 
-        spacy_docs = SPACY_MODEL.pipe((d["content"] for d in data))
+    @staticmethod
+    def _close_writer(writer, manifest=None):
+        # outputs are only moved to their final names once the file is complete
+        writer.close()
+        if manifest:
+            manifest.add(writer.inf, writer.counts[0], writer.counts[1:])
+        logger.info(f"Done with {writer.inf} after {time.time() - writer.start}s!")
+
+    def _quota_filled(self, background):
+        if not self.quota:
+            return False
+        # the quotas are updated by the written results
+        background.wait()
+        if self.quota.is_full():
+            logger.info("All quotas are filled, no further files are read.")
+            return True
+        return False
 
-        for oscar_doc, doc in zip(data, spacy_docs):
-            txt = oscar_doc["content"]
+    def _skip_completed_file(self, inf, manifest):
+        logger.info(f"Skipping {inf}, it was completed by a previous run.")
+        if not self.unmatched_only:
+            for i, count in manifest.get_counts(inf).items():
+                self.terminology.update_count(i, count)
+            for config, counts in zip(self.configs, manifest.get_config_counts(inf)):
+                for i, count in counts.items():
+                    config.terminology.update_count(i, count)
 
-            matches = self.matcher(doc)
-            for match in matches:
-                match_id = int(SPACY_MODEL.vocab.strings[match[0]])
-                match_counts[match_id] += 1
-            if self.unmatched_only:
-                    unmatched = self._get_segments_without_matches(doc)
+    def _process_chunk(self, data):
+        match_ids = []
+        config_match_ids = [[] for _ in self.configs]
+        out_data, neutral_segs, gendered_segs, common_segs, unmatched_segs = [], [], [], [], []
+        seconds = collections.Counter()
+        stats = {"docs": len(data), "skipped": 0, "quota_skipped": 0, "tokens": 0, "seconds": seconds, "pid": os.getpid()}
+        start = time.perf_counter()
+
+        # positions of the documents in the chunk, which are returned instead of the documents
+        positions = range(len(data))
+        if self.quota and self.quota.is_full():
+            # chunks that were submitted before the quotas were filled aren't matched anymore
+            positions = []
+            stats["quota_skipped"] = stats["docs"]
+        elif self.prefilter:
+            positions = [i for i in positions if self._is_candidate(data[i].content)]
+            stats["skipped"] = stats["docs"] - len(positions)
+        seconds["prefilter"] = time.perf_counter() - start
+
+        spacy_docs = pipe_windows(get_spacy_model(), (data[i].content for i in positions), self.max_window_chars, self.batch_chars)
+
+        for position, windows in zip(positions, timed(spacy_docs, seconds, "pipe")):
+            doc_neut_segs, doc_gen_segs = [], []
+            doc_has_matches = False
+            # character offset of the window in the content of the document
+            window_start = 0
+            for doc in windows:
+                stats["tokens"] += len(doc)
+                matches = self.matcher(doc)
+                match_ids.extend(match[0] for match in matches)
+                for config, ids in zip(self.configs, config_match_ids):
+                    ids.extend(match[0] for match in config.matcher(doc))
+                if self.unmatched_only:
+                    _, _, unmatched = self._get_segments_by_matches(doc, matches, position, window_start)
                     unmatched_segs.extend(unmatched)
-            if not self.unmatched_only and matches:
-                neut_segs = self._get_segments_with_matches(doc, matcher="neutral")
-                gen_segs = self._get_segments_with_matches(doc, matcher="gendered")
-                com_segs, neut_segs, gen_segs = self._sort_out_common_segments(neut_segs, gen_segs)
+                if not self.unmatched_only and matches:
+                    neut_segs, gen_segs, _ = self._get_segments_by_matches(doc, matches, position, window_start)
+                    doc_neut_segs.extend(neut_segs)
+                    doc_gen_segs.extend(gen_segs)
+                    doc_has_matches = True
+                window_start += len(doc.text)
+            if doc_has_matches:
+                com_segs, neut_segs, gen_segs = self._sort_out_common_segments(doc_neut_segs, doc_gen_segs)
                 neutral_segs.extend(neut_segs)
                 gendered_segs.extend(gen_segs)
                 common_segs.extend(com_segs)
-                out_data.append(oscar_doc)
+                out_data.append(position)
 
-        return match_counts, out_data, neutral_segs, gendered_segs, common_segs, unmatched_segs
+        match_counts = self.terminology.count_matches(match_ids)
+        config_counts = [config.terminology.count_matches(ids) for config, ids in zip(self.configs, config_match_ids)]
+        stats["matches"] = len(match_ids)
+        # matching includes extracting the segments
+        seconds["match"] = time.perf_counter() - start - seconds["prefilter"] - seconds["pipe"]
+        return match_counts, out_data, neutral_segs, gendered_segs, common_segs, unmatched_segs, config_counts, stats
+
+    def _is_candidate(self, text):
+        # documents are skipped only if they can't contain any term of any config
+        return self.prefilter.is_candidate(text) or any(config.prefilter.is_candidate(text) for config in self.configs)
 
     def _sort_out_common_segments(self, neut_segs, gen_segs):
-        gen_only_segs = [seg[1] for seg in gen_segs]
+        gen_only_segs = {seg[1] for seg in gen_segs}
         common_segs = [seg for seg in neut_segs if seg[1] in gen_only_segs]
-        common_only_segs = [seg[1] for seg in common_segs]
+        common_only_segs = {seg[1] for seg in common_segs}
         neut_segs = [seg for seg in neut_segs if seg[1] not in common_only_segs]
         gen_segs = [seg for seg in gen_segs if seg[1] not in common_only_segs]
         return common_segs, neut_segs, gen_segs
 
-    def _get_segments_without_matches(self, doc):
-        for sent in doc.sents:
-            matches = self.matcher(sent)
-            if matches:
+    def _get_segments_by_matches(self, doc, matches, position=0, window_start=0):
+        """
+        Sort the sentences of doc into sentences with neutral matches, with gendered matches and
+        without matches. Instead of running a matcher on every sentence, the matches of the whole doc
+        are assigned to the sentence they lie in and classified by the gender of the matched term.
+        Each segment is returned as (matched terms, sentence, span), span being the position of the document
+        in the chunk, the character span of the sentence in its content and the ids of all terms matched in it.
+        """
+        sents = list(doc.sents)
+        sent_starts = [sent.start for sent in sents]
+        matches_by_sent = [[] for _ in sents]
+        for match_id, start, end in matches:
+            i = bisect.bisect_right(sent_starts, start) - 1
+            # matches crossing a sentence boundary are not found in any sentence
+            if end <= sents[i].end:
+                matches_by_sent[i].append(self.terms_by_match_id[match_id])
+
+        neut_segs, gen_segs, unmatched_segs = [], [], []
+        for sent, sent_terms in zip(sents, matches_by_sent):
+            span = (position, window_start + sent.start_char, window_start + sent.end_char, [term.id for term in sent_terms])
+            if not sent_terms:
+                unmatched_segs.append(([], sent.orth_, span))
                 continue
+            neut_matches = [term.term for term in sent_terms if term.gender == "neut"]
+            gen_matches = [term.term for term in sent_terms if term.gender != "neut"]
+            if neut_matches:
+                neut_segs.append((neut_matches, sent.orth_, span))
+            if gen_matches:
+                gen_segs.append((gen_matches, sent.orth_, span))
+        return neut_segs, gen_segs, unmatched_segs
+
+    def count_and_extract(
+        self,
+        outpath,
+        inspection=False,
+        nr_cpus=None,
+        pipelined=False,
+        max_in_flight=None,
+        manifest=None,
+        dedup=None,
+        worker_output=False,
+        range_bytes=None,
+    ):
+        if manifest:
+            self._remove_stale_outputs(outpath, manifest)
+        if worker_output or range_bytes:
+            self._search_oscar_files_to_parts(
+                outpath, inspection, nr_cpus, max_in_flight=max_in_flight, manifest=manifest, range_bytes=range_bytes
+            )
+        elif pipelined:
+            self._search_oscar_files_pipelined(
+                outpath, inspection, nr_cpus, max_in_flight=max_in_flight, manifest=manifest, dedup=dedup
+            )
+        else:
+            self._search_oscar_files(outpath, inspection, nr_cpus, manifest=manifest, dedup=dedup)
+        self.metrics.log_summary()
+        if self.prefilter:
+            log_prefilter_stats(self.prefilter_stats)
+        if self.quota:
+            logger.info(f"{self.metrics.counts['quota_skipped']} documents were read after the quotas were filled and not matched.")
+        if self.metadata_filter:
+            self.metadata_filter.log_stats()
+
+
+class ExtractionWriter:
+    """
+    Writes the results of TermMatcher._process_chunk for a single OSCAR file.
+    All outputs are written to temporary files that are renamed to their final names on close,
+    so that an interrupted run never leaves partially written outputs behind.
+    With provenance, a pointer to the source of every written segment is written instead of copies of the
+    documents, see resolve_provenance.py for getting the documents or sentences back.
+    """
+
+    def __init__(
+        self,
+        inf,
+        outpath,
+        inspection=False,
+        unmatched_only=False,
+        counts=(),
+        dedup=None,
+        part=None,
+        doc_codec="gzip",
+        segment_codec="plain",
+        compression_level=None,
+        compression_threads=1,
+        provenance=False,
+        quota=None,
+    ):
+        self.inf = inf
+        self.dedup = dedup
+        self.quota = quota
+        self.provenance = provenance
+        self.part = part
+        self.segment_codec = segment_codec
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.inspection = inspection
+        self.unmatched_only = unmatched_only
+        self.start = time.time()
+        # count vectors of the terminology and the configs of the TermMatcher for the manifest
+        self.counts = counts
+        self.outfiles = []
+        stem = inf.stem.replace(".jsonl", "")
+        seg_suffix = CODEC_SUFFIXES[segment_codec]
+        self.prov_outp = None
+        if provenance:
+            prov_outfile = f"{outpath}/provenance/prov.extracted.{stem}.jsonl{CODEC_SUFFIXES[doc_codec]}"
+            self.prov_outp = self._open(prov_outfile, codec=doc_codec)
+        if unmatched_only:
+            unmatched_outfile = f"{outpath}/unmatched/seg.unm.extracted.{stem}.txt{seg_suffix}"
+            self.unm_outp = self._open(unmatched_outfile)
+            return
+        doc_outfile = f"{outpath}/doc/doc.extracted.{inf.stem}{CODEC_SUFFIXES[doc_codec]}"
+        neut_outfile = f"{outpath}/neutral/seg.neut.extracted.{stem}.{'csv' if inspection else 'txt'}{seg_suffix}"
+        gen_outfile = f"{outpath}/gendered/seg.gen.extracted.{stem}.{'csv' if inspection else 'txt'}{seg_suffix}"
+        both_outfile = f"{outpath}/both/seg.both.extracted.{stem}.{'csv' if inspection else 'txt'}{seg_suffix}"
+        self.doc_outp = None if provenance else self._open(doc_outfile, mode="wb", codec=doc_codec)
+        self.neut_outp = self._open(neut_outfile)
+        self.gen_outp = self._open(gen_outfile)
+        self.com_outp = self._open(both_outfile)
+        if inspection:
+            self.neut_writer = csv.writer(self.neut_outp, delimiter=";")
+            self.gen_writer = csv.writer(self.gen_outp, delimiter=";")
+            self.com_writer = csv.writer(self.com_outp, delimiter=";")
+
+    def write(self, result, chunk):
+        """Writes a result of TermMatcher._process_chunk for chunk, the OscarRecords it was computed from."""
+        _, out_data, neut_segs, gen_segs, com_segs, unm_segs, _, _ = result
+        if self.unmatched_only:
+            self._write_segments(self._select(unm_segs, "unmatched"), self.unm_outp, None, "unmatched", chunk)
+            return
+        neut_segs = self._select(neut_segs, "neutral")
+        gen_segs = self._select(gen_segs, "gendered")
+        com_segs = self._select(com_segs, "both")
+        if self.quota:
+            # only the documents of the segments within the quotas are written
+            out_data = sorted({span[0] for segs in [neut_segs, gen_segs, com_segs] for _, _, span in segs})
+        if not self.provenance:
+            # the workers return the positions of the documents to write, which are written as their raw lines,
+            # binary zstd writers don't implement writelines
+            self.doc_outp.write(b"".join(chunk[i].raw + b"\n" for i in out_data))
+        self._write_segments(neut_segs, self.neut_outp, self.neut_writer if self.inspection else None, "neutral", chunk)
+        self._write_segments(gen_segs, self.gen_outp, self.gen_writer if self.inspection else None, "gendered", chunk)
+        self._write_segments(com_segs, self.com_outp, self.com_writer if self.inspection else None, "both", chunk)
+
+    def _select(self, segs, category):
+        """Returns the segments with line breaks replaced that are neither duplicates nor beyond the quotas."""
+        segs = ((matches, seg.replace("\n", " "), span) for matches, seg, span in segs)
+        segs = [(matches, seg, span) for matches, seg, span in segs if not self.dedup or self.dedup.add(seg, category)]
+        return self.quota.select(segs, category) if self.quota else segs
+
+    def _write_segments(self, segs, outp, csv_writer=None, category=None, chunk=None):
+        if csv_writer:
+            csv_writer.writerows([",".join(matches), seg] for matches, seg, _ in segs)
+        else:
+            outp.writelines(f"{seg}\n" for _, seg, _ in segs)
+        if self.provenance:
+            self.prov_outp.writelines(self._get_provenance(chunk[span[0]], category, span) for _, _, span in segs)
+
+    def _get_provenance(self, record, category, span):
+        _, start, end, term_ids = span
+        pointer = {
+            "file": str(self.inf),
+            "record": record.index,
+            "frame": record.frame,
+            "offset": record.offset,
+            "category": category,
+            "start": start,
+            "end": end,
+            "terms": term_ids,
+        }
+        return f"{json.dumps(pointer)}\n"
+
+    def _open(self, outfile, mode="wt", codec=None):
+        codec = codec or self.segment_codec
+        # the part files of all chunks of a file are merged into outfile later
+        if self.part is not None:
+            outfile = f"{outfile}.part{self.part:06d}"
+        self.outfiles.append(outfile)
+        return open_output(
+            f"{outfile}.tmp", mode, codec, level=self.compression_level, threads=self.compression_threads
+        )
+
+    def close(self):
+        if self.prov_outp:
+            self.prov_outp.close()
+        if self.unmatched_only:
+            self.unm_outp.close()
+        else:
+            if self.doc_outp:
+                self.doc_outp.close()
+            self.neut_outp.close()
+            self.gen_outp.close()
+            self.com_outp.close()
+        for outfile in self.outfiles:
+            os.replace(f"{outfile}.tmp", outfile)
+
+
+class Manifest:
+    """
+    Records the completed input files of a run together with their term counts, one json line per file.
+    A resumed run skips the completed files and restores their counts from the manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as inf:
+                for line in inf:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line can be truncated if the previous run was killed while writing it
+                        continue
+                    self.completed[entry["file"]] = entry
+            logger.info(f"Resuming with {len(self.completed)} completed files from {path}.")
+        self._outf = open(path, "a", encoding="utf-8")
+        # make sure a truncated last line doesn't swallow the next entry
+        if self._outf.tell() > 0:
+            with open(path, "rb") as inf:
+                inf.seek(-1, os.SEEK_END)
+                if inf.read(1) != b"\n":
+                    self._outf.write("\n")
+
+    def is_completed(self, inf):
+        return str(inf) in self.completed
+
+    def get_counts(self, inf):
+        return {int(i): count for i, count in self.completed[str(inf)]["counts"].items()}
+
+    def get_config_counts(self, inf):
+        """Returns the counts of the CountConfigs, an empty list for files completed by a run without them."""
+        config_counts = self.completed[str(inf)].get("config_counts", [])
+        return [{int(i): count for i, count in counts.items()} for counts in config_counts]
+
+    def add(self, inf, counts, config_counts=()):
+        # counts is a count vector indexed by term id
+        entry = {"file": str(inf), "counts": {i: int(count) for i, count in enumerate(counts) if count}}
+        if config_counts:
+            entry["config_counts"] = [{i: int(count) for i, count in enumerate(c) if count} for c in config_counts]
+        self.completed[entry["file"]] = entry
+        self._outf.write(f"{json.dumps(entry)}\n")
+        self._outf.flush()
+        os.fsync(self._outf.fileno())
+
+    def close(self):
+        self._outf.close()
+
+
+class SegmentDeduplicator:
+    """
+    Drops segments that were already written by the same run, across all OSCAR files.
+    Keeps a 64-bit hash of every segment in an open addressing hash table of 8 bytes per slot,
+    which is held in memory or, for very large runs, in a memory-mapped file at path.
+    Two different segments share a hash with a negligible probability, the second one is dropped then.
+    With --resume, duplicates of segments written by previous runs are not detected.
+    """
+
+    MAX_LOAD = 0.5
+
+    def __init__(self, path=None, capacity=1 << 20):
+        self.path = path
+        self.size = 0
+        self.table = self._new_table(max(1 << (capacity - 1).bit_length(), 2))
+        self.stats = collections.defaultdict(collections.Counter)
+
+    def _new_table(self, capacity, path=None):
+        path = path or self.path
+        if path:
+            # a new file is zero filled, i.e. empty
+            return np.memmap(path, dtype=np.uint64, mode="w+", shape=(capacity,))
+        return np.zeros(capacity, dtype=np.uint64)
+
+    @staticmethod
+    def _hash(seg):
+        digest = hashlib.blake2b(seg.encode("utf-8"), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    def add(self, seg, category=None):
+        """Adds seg and returns whether it was new."""
+        self.stats[category]["segments"] += 1
+        seg_hash = self._hash(seg)
+        mask = len(self.table) - 1
+        i = seg_hash & mask
+        while True:
+            slot = int(self.table[i])
+            if slot == seg_hash:
+                self.stats[category]["duplicates"] += 1
+                return False
+            if slot == 0:
+                break
+            i = (i + 1) & mask
+        self.table[i] = seg_hash
+        self.size += 1
+        if self.size > len(self.table) * self.MAX_LOAD:
+            self._grow()
+        return True
+
+    def _grow(self):
+        hashes = self.table[self.table != 0]
+        path = f"{self.path}.tmp" if self.path else None
+        table = self._new_table(len(self.table) * 2, path)
+        mask = np.uint64(len(table) - 1)
+        positions = hashes & mask
+        # linear probing for all hashes at once, of the hashes probing the same free slot the first one gets it
+        while len(hashes):
+            free = np.flatnonzero(table[positions] == 0)
+            _, first = np.unique(positions[free], return_index=True)
+            placed = free[first]
+            table[positions[placed]] = hashes[placed]
+            rest = np.ones(len(hashes), dtype=bool)
+            rest[placed] = False
+            hashes = hashes[rest]
+            positions = (positions[rest] + np.uint64(1)) & mask
+        self.table = table
+        if self.path:
+            os.replace(path, self.path)
+
+    def write_stats(self, outpath):
+        stats = {
+            category: {
+                "segments": counts["segments"],
+                "duplicates": counts["duplicates"],
+                "kept": counts["segments"] - counts["duplicates"],
+            }
+            for category, counts in self.stats.items()
+        }
+        with open(f"{outpath}.tmp", "w", encoding="utf-8") as outf:
+            json.dump(stats, outf, indent=2)
+        os.replace(f"{outpath}.tmp", outpath)
+        for category, counts in stats.items():
+            logger.info(f"Dropped {counts['duplicates']} of {counts['segments']} {category} segments as duplicates.")
+
+    def close(self):
+        # the table is only valid for the run that filled it
+        if self.path:
+            del self.table
+            os.remove(self.path)
+
+
+class SegmentQuota:
+    """
+    Limits the extracted segments to per_term segments per term and category (neutral, gendered, both) and to total
+    segments overall. A segment is kept as long as one of its terms of its category is below the quota and counts
+    for all of them. The segments with the least represented terms of a batch are kept first.
+    The counts are kept in shared memory, so that workers writing part files see the same quotas.
+    """
+
+    CATEGORIES = ["neutral", "gendered", "both"]
+
+    def __init__(self, terminology, per_term=None, total=None):
+        self.per_term = per_term
+        self.total = total
+        n_terms = len(terminology.terms)
+        self.lock = Lock()
+        self.shared_counts = RawArray("q", len(self.CATEGORIES) * n_terms)
+        self.shared_total = RawValue("q", 0)
+        self.is_neutral = np.zeros(n_terms, dtype=bool)
+        for i, term in terminology.terms_by_id.items():
+            self.is_neutral[i] = term.gender == "neut"
+        # terms that are never matched because they are stopwords can't fill their quotas
+        self.matched = np.zeros(n_terms, dtype=bool)
+        for i, term in terminology.terms_by_id.items():
+            self.matched[i] = term.term not in get_stopwords()
+
+    @property
+    def counts(self):
+        # a view of the shared counts with a row per category
+        return np.frombuffer(self.shared_counts, dtype=np.int64).reshape(len(self.CATEGORIES), -1)
+
+    def _get_term_ids(self, term_ids, category):
+        term_ids = np.unique(np.asarray(term_ids, dtype=np.int64))
+        if category == "neutral":
+            return term_ids[self.is_neutral[term_ids]]
+        if category == "gendered":
+            return term_ids[~self.is_neutral[term_ids]]
+        return term_ids
+
+    def select(self, segs, category):
+        """Returns the segments of segs that are kept, in their order. segs are (matches, segment, span) tuples."""
+        if not segs:
+            return segs
+        kept = []
+        with self.lock:
+            if category == "unmatched":
+                # unmatched segments have no terms, only the total quota applies
+                n_kept = len(segs) if self.total is None else max(0, min(len(segs), self.total - self.shared_total.value))
+                self.shared_total.value += n_kept
+                return segs[:n_kept]
+            counts = self.counts[self.CATEGORIES.index(category)]
+            term_ids = [self._get_term_ids(span[3], category) for _, _, span in segs]
+            # the segments whose least represented term has the fewest segments so far come first
+            order = sorted(range(len(segs)), key=lambda i: counts[term_ids[i]].min() if len(term_ids[i]) else 0)
+            for i in order:
+                if self.total is not None and self.shared_total.value >= self.total:
+                    break
+                if self.per_term is not None and (counts[term_ids[i]] >= self.per_term).all():
+                    continue
+                counts[term_ids[i]] += 1
+                self.shared_total.value += 1
+                kept.append(i)
+        return [segs[i] for i in sorted(kept)]
+
+    def is_full(self):
+        """Returns whether no further segment can be kept, which ends the extraction."""
+        if self.total is not None and self.shared_total.value >= self.total:
+            return True
+        if self.per_term is None:
+            return False
+        counts = self.counts
+        # neutral segments can only fill the quotas of neutral terms and gendered ones those of gendered terms
+        return bool(
+            (counts[0][self.matched & self.is_neutral] >= self.per_term).all()
+            and (counts[1][self.matched & ~self.is_neutral] >= self.per_term).all()
+            and (counts[2][self.matched] >= self.per_term).all()
+        )
+
+    def write_stats(self, outpath):
+        counts = self.counts
+        stats = {"total": self.shared_total.value}
+        for category, category_counts in zip(self.CATEGORIES, counts):
+            stats[category] = {
+                "segments": int(category_counts.sum()),
+                "filled_terms": int((category_counts >= self.per_term).sum()) if self.per_term else None,
+                "counts": {i: int(count) for i, count in enumerate(category_counts) if count},
+            }
+        with open(f"{outpath}.tmp", "w", encoding="utf-8") as outf:
+            json.dump(stats, outf, indent=2)
+        os.replace(f"{outpath}.tmp", outpath)
+        logger.info(f"Kept {stats['total']} segments within the quotas.")
+
+
+class MetadataFilter:
+    """
+    Drops documents by their OSCAR metadata and simple statistics of their content before any NLP work.
+    A document is dropped by the first rule it fails, the rules on the metadata are checked first. Rules on metadata
+    a document doesn't have keep it, e.g. all metadata rules keep the segments read with --count-only.
+    Counts the documents and characters seen and dropped per rule.
+    """
+
+    RULES = [
+        "language",
+        "min_language_prob",
+        "annotations",
+        "categories",
+        "min_harmful_pp",
+        "min_chars",
+        "max_chars",
+        "min_alpha_ratio",
+        "max_upper_ratio",
+    ]
+
+    def __init__(
+        self,
+        language=None,
+        min_language_prob=None,
+        annotations=(),
+        categories=(),
+        min_harmful_pp=None,
+        min_chars=None,
+        max_chars=None,
+        min_alpha_ratio=None,
+        max_upper_ratio=None,
+    ):
+        self.language = language
+        self.min_language_prob = min_language_prob
+        self.annotations = set(annotations or ())
+        self.categories = set(categories or ())
+        self.min_harmful_pp = min_harmful_pp
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.min_alpha_ratio = min_alpha_ratio
+        self.max_upper_ratio = max_upper_ratio
+        # thresholds are used if given, also if they are 0, the annotation and category rules if they have any entries
+        self.rules = [
+            rule for rule in self.RULES
+            if (getattr(self, rule) if rule in ("annotations", "categories") else getattr(self, rule) is not None)
+        ]
+        self.stats = self._new_stats()
+
+    @staticmethod
+    def _new_stats():
+        return {"docs": 0, "chars": 0, "dropped_docs": collections.Counter(), "dropped_chars": collections.Counter()}
+
+    def _keep_language(self, content, metadata):
+        identification = metadata.get("identification")
+        return not identification or identification.get("label") == self.language
+
+    def _keep_min_language_prob(self, content, metadata):
+        identification = metadata.get("identification")
+        return not identification or identification.get("prob", 1.0) >= self.min_language_prob
+
+    def _keep_annotations(self, content, metadata):
+        # OSCAR 22.01 calls the quality warnings annotation, 23.01 quality_warnings
+        warnings = (metadata.get("annotation") or []) + (metadata.get("quality_warnings") or [])
+        return not self.annotations.intersection(warnings)
+
+    def _keep_categories(self, content, metadata):
+        return not self.categories.intersection(metadata.get("categories") or [])
+
+    def _keep_min_harmful_pp(self, content, metadata):
+        # the lower the perplexity of the harmful content model, the more likely the document is harmful
+        harmful_pp = metadata.get("harmful_pp")
+        return harmful_pp is None or harmful_pp >= self.min_harmful_pp
+
+    def _keep_min_chars(self, content, metadata):
+        return len(content) >= self.min_chars
+
+    def _keep_max_chars(self, content, metadata):
+        return len(content) <= self.max_chars
+
+    def _keep_min_alpha_ratio(self, content, metadata):
+        return not content or sum(map(str.isalpha, content)) / len(content) >= self.min_alpha_ratio
+
+    def _keep_max_upper_ratio(self, content, metadata):
+        letters = sum(map(str.isalpha, content))
+        return not letters or sum(map(str.isupper, content)) / letters <= self.max_upper_ratio
+
+    def get_failed_rule(self, content, metadata=None):
+        """Returns the first rule the document fails or None if it is kept."""
+        metadata = metadata or {}
+        for rule in self.rules:
+            if not getattr(self, f"_keep_{rule}")(content, metadata):
+                return rule
+        return None
+
+    def filter(self, docs):
+        """
+        Returns the kept documents of docs in their order and the stats of docs, which are OscarRecords or segments.
+        The stats are also added to the stats of the filter.
+        """
+        kept, stats = [], self._new_stats()
+        for doc in docs:
+            content, metadata = (doc.content, doc.metadata) if isinstance(doc, OscarRecord) else (doc.rstrip("\n"), None)
+            rule = self.get_failed_rule(content, metadata)
+            stats["docs"] += 1
+            stats["chars"] += len(content)
+            if rule is None:
+                kept.append(doc)
             else:
-                yield sent.orth_
-
-    def _get_segments_with_matches(self, doc, matcher):
-        segs_with_matches = []
-        for sent_doc in doc.sents:
-            if matcher == "neutral":
-                neut_matches = self.neut_matcher(sent_doc)
-                if neut_matches:
-                    neut_matches = [
-                        self.terminology.terms_by_id[int(SPACY_MODEL.vocab.strings[match[0]])].term
-                        for match in neut_matches
-                    ]
-                    segs_with_matches.append((neut_matches, sent_doc.orth_))
-            elif matcher == "gendered":
-                gen_matches = self.gendered_matcher(sent_doc)
-                if gen_matches:
-                    gen_matches = [
-                        self.terminology.terms_by_id[int(SPACY_MODEL.vocab.strings[match[0]])].term
-                        for match in gen_matches
-                    ]
-                    segs_with_matches.append((gen_matches, sent_doc.orth_))
-        return segs_with_matches
-
-    def count_and_extract(self, outpath, inspection=False, nr_cpus=None):
-        self._search_oscar_files(outpath, inspection, nr_cpus)
+                stats["dropped_docs"][rule] += 1
+                stats["dropped_chars"][rule] += len(content)
+        self.add_stats(stats)
+        return kept, stats
+
+    def add_stats(self, stats):
+        """Adds the stats of a filter call in a worker."""
+        for key, value in stats.items():
+            self.stats[key] += value
+
+    def write_stats(self, outpath):
+        stats = {"docs": self.stats["docs"], "chars": self.stats["chars"]}
+        for rule in self.rules:
+            stats[rule] = {"docs": self.stats["dropped_docs"][rule], "chars": self.stats["dropped_chars"][rule]}
+        with open(f"{outpath}.tmp", "w", encoding="utf-8") as outf:
+            json.dump(stats, outf, indent=2)
+        os.replace(f"{outpath}.tmp", outpath)
+
+    def log_stats(self):
+        docs, chars = self.stats["docs"], self.stats["chars"]
+        for rule in self.rules:
+            dropped_docs, dropped_chars = self.stats["dropped_docs"][rule], self.stats["dropped_chars"][rule]
+            doc_rate = dropped_docs / docs * 100 if docs else 0
+            char_rate = dropped_chars / chars * 100 if chars else 0
+            logger.info(
+                f"Metadata filter {rule} dropped {dropped_docs} of {docs} documents ({doc_rate:.2f}%) "
+                f"and {dropped_chars} of {chars} characters ({char_rate:.2f}%)."
+            )
 
 
 class TermCounter:
 
-    def __init__(self, terminology, match_level):
+    def __init__(
+        self,
+        terminology,
+        match_level,
+        prefilter=False,
+        max_window_chars=MAX_WINDOW_CHARS,
+        batch_chars=BATCH_CHARS,
+        metrics=None,
+        profile_dir=None,
+        configs=None,
+        metadata_filter=None,
+    ):
         self.terminology = terminology
         self.match_level = match_level
-        self.matcher = self._get_matcher(self.terminology.terms_by_id)
-        self.neut_matcher = self._get_matcher(self.terminology.neutral_terms)
-        self.gendered_matcher = self._get_matcher(self.terminology.gendered_terms)
-
-    def _get_matcher(self, terms):
-        # create spacy docs for terms
-        terms = {i: term.term for i, term in terms.items() if term.term not in DE_STOPWORDS}
-        prep_terms = list(SPACY_MODEL.pipe(terms.values()))
-        # initialize PhraseMatcher
-        matcher = PhraseMatcher(prep_terms[0].vocab, attr=self.match_level)
-        for term_id, term in zip(terms.keys(), prep_terms):
-            match_id = str(term_id)
-            matcher.add(match_id, [term])
-
-        return matcher
+        self.metadata_filter = metadata_filter
+        self.profile_dir = profile_dir
+        self.configs = configs or []
+        self.max_window_chars = max_window_chars
+        self.batch_chars = batch_chars
+        self.handle = uuid.uuid4().hex
+        self.matcher = get_phrase_matcher(self.terminology, self.terminology.terms_by_id, self.match_level)
+        self.prefilter = TermPrefilter(self.terminology, self.terminology.terms_by_id, match_level) if prefilter else None
+        self.prefilter_stats = collections.Counter()
+        self.metrics = metrics or Metrics(name="counter")
 
     # needed for serialization for multiprocessing
     def __getstate__(self):
         state = self.__dict__.copy()
-        # PhraseMatchers can't be serialized, therefore have to be deleted
+        # PhraseMatcher can't be serialized, therefore has to be deleted
         del state["matcher"]
-        del state["neut_matcher"]
-        del state["gendered_matcher"]
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        # recreate PhraseMatchers
-        self.matcher = self._get_matcher(self.terminology.terms_by_id)
-        self.neut_matcher = self._get_matcher(self.terminology.neutral_terms)
-        self.gendered_matcher = self._get_matcher(self.terminology.gendered_terms)
+        # recreate PhraseMatcher
+        self.matcher = get_phrase_matcher(self.terminology, self.terminology.terms_by_id, self.match_level)
 
     @staticmethod
     def _generate_chunks(segs_file, chunk_size):
@@ -511,47 +2216,205 @@ class TermCounter:
             else:
                 yield chunk
 
-    def _search_file(self, infile, nr_cpus=None, chunk_size=500000):
-        num_cpus = cpu_count() // 2
-        logger.info(f"Running on {num_cpus} CPUs")
+    def _search_file(self, infile, nr_cpus=None, chunk_size=500000, max_in_flight=None):
+        num_cpus = nr_cpus or max(1, cpu_count() // 2)
+        # the chunks are read lazily, so at most max_in_flight chunks are held in memory at the same time
+        max_in_flight = max_in_flight or num_cpus * 2
+        logger.info(f"Running on {num_cpus} CPUs with at most {max_in_flight} chunks in flight")
 
-        with Pool(processes=(int(num_cpus))) as pool:
-            with open(infile, "r", encoding="utf-8") as segments:
-                logger.info(f"Starting replacements in {infile}...")
+        with Pool(processes=(int(num_cpus)), initializer=init_worker, initargs=(self,)) as pool:
+            with open_input(infile) as segments:
+                logger.info(f"Starting counting in {infile}...")
                 start = time.time()
 
                 # create chunks from the spacy docs
-                chunks = self._generate_chunks(segments, chunk_size)
-                results = pool.map(self._process_chunk, chunks)
-
-                for match_counts in results:
-                    for i, count in match_counts.items():
-                        self.terminology.update_count(i, count)
+                chunks = self._generate_chunks(timed(segments, self.metrics.seconds, "read"), chunk_size)
+                if self.metadata_filter:
+                    # segments are dropped before they are sent to the workers
+                    chunks = (self.metadata_filter.filter(chunk)[0] for chunk in chunks)
+                results = imap_bounded(pool, worker_task(self, "_process_chunk"), chunks, max_in_flight)
+
+                # aggregate the counts as soon as a chunk is done
+                n_segments = 0
+                for match_counts, config_counts, stats in results:
+                    self.terminology.add_counts(match_counts)
+                    for config, counts in zip(self.configs, config_counts):
+                        config.terminology.add_counts(counts)
+                    self.prefilter_stats.update(docs=stats["docs"], skipped=stats["skipped"])
+                    self.metrics.add(stats)
+                    self.metrics.maybe_export()
+                    n_segments += stats["docs"]
+                    elapsed = time.time() - start
+                    logger.info(f"Counted {n_segments} segments after {elapsed:.1f}s ({n_segments / max(elapsed, 1e-6):.1f} segments/s).")
 
                 end = time.time()
                 logger.info(f"Done after {end - start}s!")
+        self.metrics.export()
+        self.metrics.log_summary()
 
     def _process_chunk(self, data):
-        match_counts = {i: 0 for i in self.terminology.terms_by_id.keys()}
-
-        for d in data:
-            if len(d) > SPACY_MODEL.max_length:
-                SPACY_MODEL.max_length = len(d) + 100
-
- 
-        spacy_docs = SPACY_MODEL.pipe((d for d in data))
-
-        for doc in spacy_docs:
-            matches = self.matcher(doc)
-            for match in matches:
-                match_id = int(SPACY_MODEL.vocab.strings[match[0]])
-                match_counts[match_id] += 1
-
-        return match_counts
-
-
-    def count(self, infile, nr_cpus=None):
-        self._search_file(infile)
+        match_ids = []
+        config_match_ids = [[] for _ in self.configs]
+        seconds = collections.Counter()
+        stats = {"docs": len(data), "skipped": 0, "tokens": 0, "seconds": seconds, "pid": os.getpid()}
+        start = time.perf_counter()
+
+        if self.prefilter:
+            # segments are skipped only if they can't contain any term of any config
+            data = [
+                d for d in data
+                if self.prefilter.is_candidate(d) or any(config.prefilter.is_candidate(d) for config in self.configs)
+            ]
+            stats["skipped"] = stats["docs"] - len(data)
+        seconds["prefilter"] = time.perf_counter() - start
+
+        spacy_docs = pipe_windows(get_spacy_model(), data, self.max_window_chars, self.batch_chars)
+        for windows in timed(spacy_docs, seconds, "pipe"):
+            for doc in windows:
+                stats["tokens"] += len(doc)
+                match_ids.extend(match[0] for match in self.matcher(doc))
+                for config, ids in zip(self.configs, config_match_ids):
+                    ids.extend(match[0] for match in config.matcher(doc))
+
+        stats["matches"] = len(match_ids)
+        seconds["match"] = time.perf_counter() - start - seconds["prefilter"] - seconds["pipe"]
+        config_counts = [config.terminology.count_matches(ids) for config, ids in zip(self.configs, config_match_ids)]
+        return self.terminology.count_matches(match_ids), config_counts, stats
+
+
+    def count(self, infile, nr_cpus=None, manifest=None, max_in_flight=None):
+        if manifest and manifest.is_completed(infile):
+            logger.info(f"Skipping {infile}, it was completed by a previous run.")
+            for i, count in manifest.get_counts(infile).items():
+                self.terminology.update_count(i, count)
+            for config, counts in zip(self.configs, manifest.get_config_counts(infile)):
+                for i, count in counts.items():
+                    config.terminology.update_count(i, count)
+            return
+        counts_before = self.terminology.count_array.copy()
+        config_counts_before = [config.terminology.count_array.copy() for config in self.configs]
+        self._search_file(infile, nr_cpus, max_in_flight=max_in_flight)
+        if manifest:
+            config_counts = [
+                config.terminology.count_array - before for config, before in zip(self.configs, config_counts_before)
+            ]
+            manifest.add(infile, self.terminology.count_array - counts_before, config_counts)
+        if self.prefilter:
+            log_prefilter_stats(self.prefilter_stats)
+        if self.metadata_filter:
+            self.metadata_filter.log_stats()
+
+
+class TermPrefilter:
+    """
+    Cheap check on the raw text whether a document can contain a match of the terminology at all,
+    so that documents without any candidate are never run through spaCy.
+    Every term of the matcher contributes its longest token, which each text matching the term at orth level contains.
+    At lemma level a token can match with any surface form of its lemma, which the raw text can't be checked for,
+    so only orth matching can be prefiltered without losing matches.
+    Uses an Aho-Corasick automaton if pyahocorasick is installed and a regular expression otherwise.
+    """
+
+    def __init__(self, terminology, terms, match_level):
+        if match_level != "ORTH":
+            raise ValueError(f"The prefilter can only be used at match level orth, not {match_level.lower()}.")
+        # same terms as in the matcher
+        terms = [i for i, term in terms.items() if term.term not in get_stopwords()]
+        keys = set()
+        for prep_term in terminology.get_patterns(terms, get_spacy_model()):
+            keys.add(max((token.orth_ for token in prep_term), key=len))
+        # a term without a usable key could match anywhere
+        self.match_all = "" in keys or not keys
+        self.keys = sorted(keys, key=len, reverse=True)
+        logger.info(f"Prefilter compiled with {len(self.keys)} keys{', every document is a candidate' if self.match_all else ''}.")
+        self.automaton = None
+        self.pattern = None
+        if self.match_all:
+            return
+        if ahocorasick:
+            self.automaton = ahocorasick.Automaton()
+            for key in self.keys:
+                self.automaton.add_word(key, key)
+            self.automaton.make_automaton()
+        else:
+            self.pattern = re.compile("|".join(re.escape(key) for key in self.keys))
+
+    def is_candidate(self, text):
+        if self.match_all:
+            return True
+        if self.automaton:
+            return next(self.automaton.iter(text), None) is not None
+        return self.pattern.search(text) is not None
+
+
+def split_text(text, max_chars):
+    """
+    Splits text into consecutive windows of at most max_chars characters that join back to text.
+    Windows end at the last line break, else at the last sentence end, else at the last space
+    in the window, and only text without any of them is cut hard.
+    """
+    windows = []
+    while len(text) > max_chars:
+        window = text[:max_chars]
+        cut = window.rfind("\n") + 1
+        if not cut:
+            cut = max(window.rfind(". "), window.rfind("! "), window.rfind("? ")) + 2
+            if cut == 1:
+                cut = window.rfind(" ") + 1 or max_chars
+        windows.append(text[:cut])
+        text = text[cut:]
+    windows.append(text)
+    return windows
+
+
+def pipe_by_chars(model, texts, batch_chars):
+    """
+    Like model.pipe, but batches hold up to batch_chars characters instead of a fixed number of texts,
+    so that batches of long documents don't take much more memory than batches of short ones.
+    """
+    batch, nr_chars = [], 0
+    for text in texts:
+        if batch and nr_chars + len(text) > batch_chars:
+            yield from model.pipe(batch, batch_size=len(batch))
+            batch, nr_chars = [], 0
+        batch.append(text)
+        nr_chars += len(text)
+    if batch:
+        yield from model.pipe(batch, batch_size=len(batch))
+
+
+def pipe_windows(model, texts, max_window_chars=MAX_WINDOW_CHARS, batch_chars=BATCH_CHARS):
+    """
+    Runs texts through model, splitting texts longer than max_window_chars with split_text instead of raising
+    model.max_length, which makes memory use grow with the longest document. Yields the list of window docs
+    for every text in order.
+    """
+    model.max_length = max(model.max_length, max_window_chars)
+    windows = [split_text(text, max_window_chars) for text in texts]
+    docs = pipe_by_chars(model, (window for text_windows in windows for window in text_windows), batch_chars)
+    for text_windows in windows:
+        yield [next(docs) for _ in text_windows]
+
+
+def imap_bounded(pool, func, iterable, max_in_flight):
+    """
+    Like pool.imap, but the next item is only taken from iterable while fewer than max_in_flight tasks are
+    pending. pool.map and pool.imap consume the whole iterable up front, which holds all of it in memory.
+    Results are yielded in order.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def log_prefilter_stats(stats):
+    docs, skipped = stats["docs"], stats["skipped"]
+    skip_rate = skipped / docs * 100 if docs else 0
+    logger.info(f"Prefilter skipped {skipped} of {docs} documents ({skip_rate:.2f}%).")
 
 
 def parse_args():
@@ -589,7 +2452,186 @@ def parse_args():
         action="store_true",
         help="Only extract segments where no term was matched."
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Read and chunk the next OSCAR files while the current ones are still matched instead of processing one file at a time.",
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Skip documents that don't contain any term before running spaCy. Only possible with --match-level orth and orth --extra-count, since the surface forms of a lemma can't be searched for in the raw text. Install pyahocorasick for the fastest search.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Record completed input files in a manifest and skip the files completed by a previous run with the same manifest.",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Path to the manifest used with --resume. Defaults to manifest.jsonl in the --extracted directory or <--count>.manifest.jsonl with --count-only.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Only process shard i of N (given as i/N, 0-based) of the OSCAR files. Files are distributed by size. Merge the count files of all shards with merge_counts.py.",
+    )
+    parser.add_argument(
+        "--terminology-cache",
+        help="Directory where the parsed terminology and the spaCy docs of its terms are cached for later runs.",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        help="Maximum number of chunks submitted to the workers at the same time in pipelined mode, with --worker-output and with --count-only. Defaults to twice the number of cores.",
+    )
+    parser.add_argument(
+        "--max-window-chars",
+        type=int,
+        default=MAX_WINDOW_CHARS,
+        help=f"Match documents longer than this many characters in windows split at line breaks or sentence ends. Defaults to {MAX_WINDOW_CHARS}.",
+    )
+    parser.add_argument(
+        "--batch-chars",
+        type=int,
+        default=BATCH_CHARS,
+        help=f"Number of characters run through spaCy in one batch. Defaults to {BATCH_CHARS}.",
+    )
+    parser.add_argument(
+        "--doc-codec",
+        choices=list(CODEC_SUFFIXES),
+        default="gzip",
+        help="Compression of the extracted documents. Defaults to gzip.",
+    )
+    parser.add_argument(
+        "--segment-codec",
+        choices=list(CODEC_SUFFIXES),
+        default="plain",
+        help="Compression of the extracted segments. replace.py, filter_by_terms.py and --count-only read compressed segments directly. Defaults to plain.",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="Compression level of zstd or gzip. Defaults to 3 for zstd and 9 for gzip.",
+    )
+    parser.add_argument(
+        "--compression-threads",
+        type=int,
+        default=1,
+        help="Number of background threads compressing each zstd output. 0 compresses in the main process thread. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Export throughput, time per stage, queue depths and worker utilization to this file periodically. Appends json lines, or writes a Prometheus textfile if the path ends with .prom.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=30.0,
+        help="Seconds between two exports of --metrics. Defaults to 30.",
+    )
+    parser.add_argument(
+        "--worker-output",
+        action="store_true",
+        help="Let the workers decode their chunks and write the extracted data to part files, which are merged per OSCAR file. Only counts and file names are sent back to the main process. Can't be combined with --dedup.",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Only write the first occurrence of each extracted segment across all OSCAR files of this run. Can't be combined with --shard, whose runs don't share the seen segments. Statistics are written to <--count>.dedup.json.",
+    )
+    parser.add_argument(
+        "--dedup-file",
+        help="Keep the hashes of the segments seen by --dedup in this file instead of in memory (8 bytes per slot, the table is kept at most half full). Implies --dedup.",
+    )
+    parser.add_argument(
+        "--provenance",
+        action="store_true",
+        help="Instead of copying the documents with matches to doc/, write a json line per extracted segment to provenance/ with the OSCAR file, the index and byte offset of the document in the decompressed file, the character span of the segment in its content and the ids of the matched terms. Use resolve_provenance.py to get the documents or segments back.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profile the main process and every worker with cProfile and merge the profiles into DIR/profile.prof (pstats), DIR/profile.collapsed (collapsed stacks for flame graphs) and DIR/profile.txt (time per spaCy component, matcher and I/O and the top functions).",
+    )
+    parser.add_argument(
+        "--extra-count",
+        nargs=3,
+        action="append",
+        default=[],
+        metavar=("TERMINOLOGY", "MATCH_LEVEL", "COUNT"),
+        help="Also count the terms of another terminology csv file at match level lemma or orth on the same spaCy docs and write the counts to COUNT. Can be given several times, the documents are still tagged and lemmatized only once. Only --terminology is used for extraction.",
+    )
+    parser.add_argument(
+        "--byte-range-mb",
+        type=float,
+        help="Let the workers read and decompress byte ranges of about this many MB of the OSCAR files themselves instead of reading the files in the main process. zstd files are split between frames, so single frame files and gzip files aren't split. Implies --worker-output. The provenance outputs then have no record index.",
+    )
+    parser.add_argument(
+        "--quota",
+        type=int,
+        help="Extract at most this many segments per term for each of neutral, gendered and both, preferring segments of the least represented terms. Reading stops once all quotas are filled. Statistics are written to <--count>.quota.json, the counts only cover the documents read until then.",
+    )
+    parser.add_argument(
+        "--quota-total",
+        type=int,
+        help="Extract at most this many segments overall, reading stops once they are extracted. Can be combined with --quota.",
+    )
+    parser.add_argument(
+        "--filter-language",
+        help="Drop documents whose OSCAR language identification label is not this language, e.g. de.",
+    )
+    parser.add_argument(
+        "--filter-min-language-prob",
+        type=float,
+        help="Drop documents whose OSCAR language identification probability is below this threshold.",
+    )
+    parser.add_argument(
+        "--filter-annotations",
+        nargs="+",
+        default=[],
+        help="Drop documents with any of these OSCAR quality warnings, e.g. tiny short_sentences header footer noisy adult.",
+    )
+    parser.add_argument(
+        "--filter-categories",
+        nargs="+",
+        default=[],
+        help="Drop documents with any of these OSCAR 23.01 blocklist categories, e.g. adult.",
+    )
+    parser.add_argument(
+        "--filter-min-harmful-pp",
+        type=float,
+        help="Drop documents whose OSCAR 23.01 harmful content perplexity is below this threshold.",
+    )
+    parser.add_argument("--filter-min-chars", type=int, help="Drop documents or segments with fewer characters.")
+    parser.add_argument("--filter-max-chars", type=int, help="Drop documents or segments with more characters.")
+    parser.add_argument(
+        "--filter-min-alpha-ratio",
+        type=float,
+        help="Drop documents or segments whose share of letters among all characters is below this ratio.",
+    )
+    parser.add_argument(
+        "--filter-max-upper-ratio",
+        type=float,
+        help="Drop documents or segments whose share of uppercase letters among all letters is above this ratio.",
+    )
+    args = parser.parse_args()
+    for _, match_level, _ in args.extra_count:
+        if match_level not in ["lemma", "orth"]:
+            parser.error(f"The match level of --extra-count must be lemma or orth, got {match_level}.")
+    if args.prefilter and any(match_level != "orth" for match_level in [args.match_level] + [count[1] for count in args.extra_count]):
+        parser.error("--prefilter can only be used with --match-level orth, it would skip documents with matches of other surface forms of a lemma.")
+    if args.extra_count and args.unmatched_only:
+        parser.error("--extra-count can't be combined with --unmatched-only, which doesn't count any terms.")
+    if args.shard and args.count_only:
+        parser.error("--shard only splits the OSCAR files and can't be combined with --count-only, every shard would count the whole segment file.")
+    if (args.quota or args.quota_total) and args.resume:
+        parser.error("--quota and --quota-total can't be combined with --resume, the quotas aren't restored from the manifest and files are left partially read.")
+    if args.shard and (args.dedup or args.dedup_file):
+        parser.error("--dedup only sees the segments of its own process and can't be combined with --shard, duplicates in different shards would all be kept.")
+    if (args.worker_output or args.byte_range_mb) and (args.dedup or args.dedup_file):
+        parser.error("--dedup needs all segments in the main process and can't be combined with --worker-output or --byte-range-mb.")
+    return args
 
 
 def index_files(indir, suffixes=""):
@@ -602,15 +2644,80 @@ def index_files(indir, suffixes=""):
     return fnames
 
 
+def parse_shard(shard):
+    """Parses a shard specification i/N with 0 <= i < N."""
+    try:
+        shard, num_shards = (int(n) for n in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must be given as i/N, got {shard}.")
+    if not 0 <= shard < num_shards:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 0 and {num_shards - 1}, got {shard}.")
+    return shard, num_shards
+
+
+def shard_files(fnames, shard, num_shards):
+    """
+    Returns the files belonging to the given shard. The files are distributed by size, largest first,
+    always to the shard with the least bytes so far. The assignment only depends on the file names and
+    sizes, so all nodes compute the same partitioning without any coordination.
+    """
+    fnames = sorted(fnames, key=lambda fname: (-os.path.getsize(fname), str(fname)))
+    shard_sizes = [0] * num_shards
+    shard_fnames = [[] for _ in range(num_shards)]
+    for fname in fnames:
+        smallest = min(range(num_shards), key=lambda i: (shard_sizes[i], i))
+        shard_sizes[smallest] += os.path.getsize(fname)
+        shard_fnames[smallest].append(fname)
+    return shard_fnames[shard]
+
+
 def main(args):
+    metadata_filter = MetadataFilter(
+        language=args.filter_language,
+        min_language_prob=args.filter_min_language_prob,
+        annotations=args.filter_annotations,
+        categories=args.filter_categories,
+        min_harmful_pp=args.filter_min_harmful_pp,
+        min_chars=args.filter_min_chars,
+        max_chars=args.filter_max_chars,
+        min_alpha_ratio=args.filter_min_alpha_ratio,
+        max_upper_ratio=args.filter_max_upper_ratio,
+    )
+    # the documents are only filtered if any rule is given
+    metadata_filter = metadata_filter if metadata_filter.rules else None
+    profiler = None
+    if args.profile:
+        Profiler.clear(args.profile)
+        profiler = Profiler(args.profile).start()
+    configs = [
+        CountConfig(Terminology(path, cache_dir=args.terminology_cache), match_level.upper(), count, args.prefilter)
+        for path, match_level, count in args.extra_count
+    ]
     if args.count_only:
         logger.info(f"***** Start counting in {args.inpath} *****")
         start = time.time()
 
-        terminology = Terminology(args.terminology)
-        term_counter = TermCounter(terminology, args.match_level.upper())
-        term_counter.count(args.inpath)
+        terminology = Terminology(args.terminology, cache_dir=args.terminology_cache)
+        term_counter = TermCounter(
+            terminology,
+            args.match_level.upper(),
+            prefilter=args.prefilter,
+            max_window_chars=args.max_window_chars,
+            batch_chars=args.batch_chars,
+            metrics=Metrics(args.metrics, args.metrics_interval, name="counter"),
+            profile_dir=args.profile,
+            configs=configs,
+            metadata_filter=metadata_filter,
+        )
+        manifest = Manifest(args.manifest or f"{args.count}.manifest.jsonl") if args.resume else None
+        term_counter.count(args.inpath, nr_cpus=args.cores, manifest=manifest, max_in_flight=args.max_in_flight)
         terminology.write_counts(args.count)
+        for config in configs:
+            config.write_counts()
+        if metadata_filter:
+            metadata_filter.write_stats(f"{args.count}.metadata_filter.json")
+        if manifest:
+            manifest.close()
 
         end = time.time()
         logger.info(f"***** Finished counting. Time taken: {end - start}s *****")
@@ -618,14 +2725,64 @@ def main(args):
         logger.info(f"***** Start filtering of OSCAR files *****")
         start = time.time()
 
-        terminology = Terminology(args.terminology)
-        term_matcher = TermMatcher(args.inpath, terminology, args.match_level.upper(), unmatched_only=args.unmatched_only)
-        term_matcher.count_and_extract(args.extracted, args.inspection)
+        terminology = Terminology(args.terminology, cache_dir=args.terminology_cache)
+        quota = SegmentQuota(terminology, args.quota, args.quota_total) if args.quota or args.quota_total else None
+        term_matcher = TermMatcher(
+            args.inpath,
+            terminology,
+            args.match_level.upper(),
+            unmatched_only=args.unmatched_only,
+            prefilter=args.prefilter,
+            shard=args.shard,
+            max_window_chars=args.max_window_chars,
+            batch_chars=args.batch_chars,
+            doc_codec=args.doc_codec,
+            segment_codec=args.segment_codec,
+            compression_level=args.compression_level,
+            compression_threads=args.compression_threads,
+            metrics=Metrics(args.metrics, args.metrics_interval),
+            provenance=args.provenance,
+            profile_dir=args.profile,
+            configs=configs,
+            quota=quota,
+            metadata_filter=metadata_filter,
+        )
+        default_manifest = f"{args.extracted}/manifest.jsonl"
+        if args.shard:
+            default_manifest = f"{args.extracted}/manifest.shard{args.shard[0]}of{args.shard[1]}.jsonl"
+        manifest = Manifest(args.manifest or default_manifest) if args.resume else None
+        dedup = SegmentDeduplicator(args.dedup_file) if args.dedup or args.dedup_file else None
+        term_matcher.count_and_extract(
+            args.extracted,
+            args.inspection,
+            nr_cpus=args.cores,
+            pipelined=args.pipelined,
+            max_in_flight=args.max_in_flight,
+            manifest=manifest,
+            dedup=dedup,
+            worker_output=args.worker_output,
+            range_bytes=int(args.byte_range_mb * (1 << 20)) if args.byte_range_mb else None,
+        )
         terminology.write_counts(args.count)
+        for config in configs:
+            config.write_counts()
+        if quota:
+            quota.write_stats(f"{args.count}.quota.json")
+        if metadata_filter:
+            metadata_filter.write_stats(f"{args.count}.metadata_filter.json")
+        if dedup:
+            dedup.write_stats(f"{args.count}.dedup.json")
+            dedup.close()
+        if manifest:
+            manifest.close()
 
         end = time.time()
         logger.info(f"***** Finished filtering. Time taken: {end - start}s *****")
 
+    if profiler:
+        profiler.stop()
+        merge_profiles(args.profile)
+
 
 if __name__ == "__main__":
     args = parse_args()
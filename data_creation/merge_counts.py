@@ -0,0 +1,48 @@
+import argparse
+import csv
+import os
+
+
+def merge_counts(count_files, outfile):
+    """
+    Sum up the term counts of count files written by Terminology.write_counts for the same terminology,
+    e.g. by the shards of a run of frequencies.py. The merged file has the same format.
+    """
+    header, rows = None, None
+    for count_file in count_files:
+        with open(count_file, "r", encoding="utf-8", newline="") as inf:
+            reader = csv.reader(inf, delimiter=",")
+            file_header = next(reader)
+            file_rows = list(reader)
+        if rows is None:
+            header, rows = file_header, file_rows
+            continue
+        if file_header != header or len(file_rows) != len(rows):
+            raise ValueError(f"{count_file} was not created with the same terminology as {count_files[0]}.")
+        count_index = header.index("count")
+        for row, file_row in zip(rows, file_rows):
+            if row[:count_index] + row[count_index + 1 :] != file_row[:count_index] + file_row[count_index + 1 :]:
+                raise ValueError(f"{count_file} was not created with the same terminology as {count_files[0]}.")
+            row[count_index] = int(row[count_index]) + int(file_row[count_index])
+
+    with open(f"{outfile}.tmp", "w", encoding="utf-8", newline="") as outf:
+        writer = csv.writer(outf, delimiter=",")
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(f"{outfile}.tmp", outfile)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", nargs="+", required=True, help="Count files of the shards")
+    parser.add_argument("--out", required=True, help="Path to outfile containing the merged term counts")
+    return parser.parse_args()
+
+
+def main(args):
+    merge_counts(args.counts, args.out)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
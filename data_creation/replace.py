@@ -1,4 +1,5 @@
 import argparse
+import collections
 import csv
 import random
 import logging
@@ -8,13 +9,21 @@ import os
 import uuid
 from pathlib import Path
 
-import spacy
-import nltk
-from nltk.corpus import stopwords
-from spacy.matcher import PhraseMatcher
 from multiprocessing import Pool, cpu_count
 
-from tools.frequencies import Terminology
+from tools.frequencies import (
+    Metrics,
+    Profiler,
+    Terminology,
+    get_spacy_model,
+    get_stopwords,
+    init_worker,
+    merge_profiles,
+    open_input,
+    strip_codec_suffix,
+    timed,
+    worker_task,
+)
 
 # Create a logger
 logger = logging.getLogger(__name__)
@@ -24,25 +33,33 @@ formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-SPACY_MODEL = spacy.load("de_core_news_sm", disable=["morphologizer", "parser", "ner"])
-nltk.data.path.append("/srv/scratch3/hauser/gender-neutral")
-DE_STOPWORDS = stopwords.words("german")
+SPACY_EXCLUDE = ["morphologizer", "parser", "ner"]
+NLTK_DATA_PATH = "/srv/scratch3/hauser/gender-neutral"
+
+
+def get_model():
+    return get_spacy_model(exclude=SPACY_EXCLUDE, enable=[])
 
 
 class Replacer:
-    def __init__(self, terminology, outprefix, match_level="lemma", target="gendered"):
+    def __init__(self, terminology, outprefix, match_level="lemma", target="gendered", metrics=None, profile_dir=None):
         self.terminology = terminology
+        self.profile_dir = profile_dir
         self.outfile_prefix = outprefix
         self.match_level = match_level
         self.terms = self.terminology.gendered_terms if target == "neutral" else self.terminology.neutral_terms
         self.target = target
+        self.handle = uuid.uuid4().hex
         self.matcher = self._get_matcher(self.terms)
+        self.metrics = metrics or Metrics(name="replacer")
 
     def _get_matcher(self, terms):
         # create spacy docs for terms
         # remove stopwords that produce too many false positive matches
-        terms = {i: term.term for i, term in terms.items() if term.term not in DE_STOPWORDS}
-        prep_terms = list(SPACY_MODEL.pipe(terms.values()))
+        from spacy.matcher import PhraseMatcher
+
+        terms = {i: term.term for i, term in terms.items() if term.term not in get_stopwords(nltk_data_path=NLTK_DATA_PATH)}
+        prep_terms = self.terminology.get_patterns(terms.keys(), get_model())
         # initialize PhraseMatcher
         matcher = PhraseMatcher(prep_terms[0].vocab, attr=self.match_level)
         for term_id, term in zip(terms.keys(), prep_terms):
@@ -64,7 +81,7 @@ class Replacer:
         self.matcher = self._get_matcher(self.terms)
 
     def _get_replacement(self, match):
-        match_id = int(SPACY_MODEL.vocab.strings[match[0]])
+        match_id = int(get_model().vocab.strings[match[0]])
         matched_term = self.terminology.terms_by_id[match_id]
         if self.target == "feminine":
             correspondences = matched_term.f_correspondences
@@ -91,7 +108,7 @@ class Replacer:
     @staticmethod
     def _generate_chunks_from_files(files):
         for fname in files:
-            with open(fname, "r", encoding="utf-8") as inf:
+            with open_input(fname) as inf:
                 yield (fname, inf.readlines())
         
 
@@ -99,38 +116,45 @@ class Replacer:
         # FIXME: this file naming scrambles up the order of the files in the output directory!!!
         #i = str(uuid.uuid4())
         #outfile = os.path.join(self.outfile_prefix, f'output_{i}.gen')
-        outfile = os.path.join(self.outfile_prefix, f"replaced.{os.path.basename(chunk[0])}")
-        start = time.time()
-        print(f"Processing file {outfile}", flush=True)
+        outfile = os.path.join(self.outfile_prefix, f"replaced.{os.path.basename(strip_codec_suffix(chunk[0]))}")
+        seconds = collections.Counter()
+        stats = {"docs": len(chunk[1]), "tokens": 0, "matches": 0, "seconds": seconds, "pid": os.getpid()}
+        start = time.perf_counter()
         with open(outfile, "w", encoding="utf-8") as outf:
-            seg_docs = SPACY_MODEL.pipe(chunk[1])
-            print(f"Done creating spacy docs for file {outfile}", flush=True)
-            for segment in seg_docs:
-                replaced_segment, _, _ = self._replace_segment(segment)
+            seg_docs = get_model().pipe(chunk[1])
+            for segment in timed(seg_docs, seconds, "pipe"):
+                replaced_segment, matches, _ = self._replace_segment(segment)
+                stats["tokens"] += len(segment)
+                stats["matches"] += len(matches)
                 outf.write(replaced_segment)
-                outf.flush
-        print(f"Done with file {outfile} after {time.time() - start}.", flush=True)
-        return outfile
+        # replacing includes writing the replaced segments
+        seconds["replace"] = time.perf_counter() - start - seconds["pipe"]
+        return outfile, stats
 
     def replace(self, segments_path, outfile, nr_cpus=None, chunk_size=500000):
 
-        num_cpus = nr_cpus or (cpu_count() // 2)
+        num_cpus = nr_cpus or max(1, cpu_count() // 2)
         logger.info(f"Running on {num_cpus} CPUs")
         
         segments_files = index_files(segments_path)
 
-        with Pool(processes=num_cpus) as pool:
+        with Pool(processes=num_cpus, initializer=init_worker, initargs=(self,)) as pool:
             #with open(segments_file, "r", encoding="utf-8") as segments:
             logger.info(f"Starting replacements in {segments_path}...")
             start = time.time()
 
             # create chunks from the spacy docs
             # chunks = self._generate_chunks(segments, chunk_size)
-            chunks = self._generate_chunks_from_files(segments_files)
-            results = pool.map(self._process_chunk, chunks)
+            chunks = timed(self._generate_chunks_from_files(segments_files), self.metrics.seconds, "read")
+            for outfile, stats in pool.imap(worker_task(self, "_process_chunk"), chunks):
+                self.metrics.add(stats)
+                self.metrics.maybe_export()
+                logger.info(f"Done with file {outfile} after {sum(stats['seconds'].values()):.1f}s.")
 
             end = time.time()
             logger.info(f"Done after {end - start}s!")
+        self.metrics.export()
+        self.metrics.log_summary()
 
     def _replace_segment(self, seg_doc):
         # for reproducibility
@@ -158,7 +182,7 @@ class Replacer:
         if current_index < len(seg_doc):
             replaced_segment += seg_doc[current_index:].text
         matches = [
-            self.terminology.terms_by_id[int(SPACY_MODEL.vocab.strings[match[0]])].term
+            self.terminology.terms_by_id[int(get_model().vocab.strings[match[0]])].term
             for match in matches
         ]
         return replaced_segment, matches, replacements
@@ -217,16 +241,49 @@ def parse_args():
         "--cores",
         type=int
     )
+    parser.add_argument(
+        "--terminology-cache",
+        help="Directory where the parsed terminology and the spaCy docs of its terms are cached for later runs.",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Export throughput, time per stage and worker utilization to this file periodically. Appends json lines, or writes a Prometheus textfile if the path ends with .prom.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=30.0,
+        help="Seconds between two exports of --metrics. Defaults to 30.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Profile the main process and every worker with cProfile and merge the profiles into DIR/profile.prof (pstats), DIR/profile.collapsed (collapsed stacks for flame graphs) and DIR/profile.txt (time per spaCy component, matcher and I/O and the top functions).",
+    )
     return parser.parse_args()
 
 
 def main(args):
-    terminology = Terminology(args.terminology)
+    profiler = None
+    if args.profile:
+        Profiler.clear(args.profile)
+        profiler = Profiler(args.profile).start()
+    terminology = Terminology(args.terminology, cache_dir=args.terminology_cache)
     logger.info(f"Terminology is loaded.")
-    replacer = Replacer(terminology, args.outprefix, match_level=args.match_level, target=args.target)
+    replacer = Replacer(
+        terminology,
+        args.outprefix,
+        match_level=args.match_level,
+        target=args.target,
+        metrics=Metrics(args.metrics, args.metrics_interval, name="replacer"),
+        profile_dir=args.profile,
+    )
     logger.info("Replacer is initialized.")
     outpath = f"{args.outprefix}.{'csv' if args.inspection else 'txt'}"
     replacer.replace(args.segments, outpath, nr_cpus=args.cores)
+    if profiler:
+        profiler.stop()
+        merge_profiles(args.profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import argparse
+import collections
+import json
+import os
+
+from tools.frequencies import decode_oscar_record, index_files, open_input, open_output
+
+# bytes skipped per read when seeking forward in a decompressed stream
+SKIP_SIZE = 1 << 20
+
+
+def read_pointers(provenance_path, categories=None):
+    """
+    Returns the pointers of the provenance files written by frequencies.py --provenance grouped by OSCAR file
+    and the zstd frame their offsets are relative to.
+    """
+    pointers = collections.defaultdict(list)
+    provenance_files = [provenance_path] if os.path.isfile(provenance_path) else index_files(provenance_path, ".jsonl*")
+    for provenance_file in sorted(provenance_files):
+        with open_input(provenance_file) as inf:
+            for line in inf:
+                pointer = json.loads(line)
+                if not categories or pointer["category"] in categories:
+                    pointers[pointer["file"], pointer.get("frame", 0)].append(pointer)
+    return pointers
+
+
+def resolve_file(oscar_file, pointers, frame=0):
+    """
+    Yields (pointer, OscarRecord) for the pointers into oscar_file in the order of the file. The file is decompressed
+    once as a stream from byte frame on, the bytes up to the next pointed to document are skipped without decoding them.
+    """
+    pointers = sorted(pointers, key=lambda pointer: pointer["offset"])
+    with open_input(oscar_file, "rb", frame) as inp:
+        position, record = 0, None
+        for pointer in pointers:
+            if record is None or pointer["offset"] != record.offset:
+                while position < pointer["offset"]:
+                    skipped = len(inp.read(min(SKIP_SIZE, pointer["offset"] - position)))
+                    if not skipped:
+                        raise ValueError(f"{oscar_file} ends before offset {pointer['offset']}.")
+                    position += skipped
+                line = inp.readline()
+                position += len(line)
+                record = decode_oscar_record(line, pointer["record"], pointer["offset"], frame)
+            yield pointer, record
+
+
+def resolve(provenance_path, outfile, documents=False, categories=None, oscar_path=None):
+    """
+    Writes the segments, or with documents the raw json lines of the documents, the pointers of the provenance files
+    at provenance_path point to. The documents are written once each, in the order of the OSCAR files.
+    oscar_path replaces the directory of the OSCAR files recorded in the pointers, e.g. if the corpus was moved.
+    """
+    pointers = read_pointers(provenance_path, categories)
+    with open_output(f"{outfile}.tmp", "wb" if documents else "wt", codec="gzip" if documents else "plain") as outf:
+        for oscar_file, frame in sorted(pointers):
+            inf = os.path.join(oscar_path, os.path.basename(oscar_file)) if oscar_path else oscar_file
+            last_offset = None
+            for pointer, record in resolve_file(inf, pointers[oscar_file, frame], frame):
+                if documents:
+                    if record.offset != last_offset:
+                        outf.write(record.raw + b"\n")
+                    last_offset = record.offset
+                else:
+                    segment = record.content[pointer["start"] : pointer["end"]].replace("\n", " ")
+                    outf.write(f"{segment}\n")
+    os.replace(f"{outfile}.tmp", outfile)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Get the segments or documents of the provenance files written by frequencies.py --provenance back from the OSCAR files.")
+    parser.add_argument("--provenance", required=True, help="Provenance file or directory containing provenance files")
+    parser.add_argument("--out", required=True, help="Path to outfile, gzipped with --documents")
+    parser.add_argument(
+        "--documents",
+        action="store_true",
+        help="Write the documents as the raw json lines of the OSCAR files like the doc/ outputs instead of the segments.",
+    )
+    parser.add_argument(
+        "--categories",
+        nargs="+",
+        choices=["neutral", "gendered", "both", "unmatched"],
+        help="Only resolve the pointers of these segment categories. Defaults to all.",
+    )
+    parser.add_argument("--oscar-path", help="Directory the OSCAR files are read from instead of the one recorded in the pointers")
+    return parser.parse_args()
+
+
+def main(args):
+    resolve(args.provenance, args.out, args.documents, args.categories, args.oscar_path)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
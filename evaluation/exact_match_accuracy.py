@@ -2,19 +2,29 @@ import argparse
 import csv
 import os
 from collections import defaultdict
-from tools.frequencies import Terminology
+from typing import TYPE_CHECKING
+from tools.frequencies import Terminology, get_spacy_model
 
-import spacy
-from spacy.matcher import PhraseMatcher
+if TYPE_CHECKING:
+    from spacy.matcher import PhraseMatcher
 
 
-SPACY_MODEL = spacy.load("de_core_news_sm", disable=["ner"])
+SPACY_EXCLUDE = ["ner"]
 
 
-def get_matcher(terms):
-    # create spacy docs for terms
+def get_model():
+    return get_spacy_model(exclude=SPACY_EXCLUDE, enable=[])
+
+
+def get_matcher(terms, terminology=None):
+    from spacy.matcher import PhraseMatcher
+
+    # create spacy docs for terms, reusing the docs created by the terminology if available
     terms = {i: term.term for i, term in terms.items()}
-    prep_terms = list(SPACY_MODEL.pipe(terms.values()))
+    if terminology:
+        prep_terms = terminology.get_patterns(terms.keys(), get_model())
+    else:
+        prep_terms = list(get_model().pipe(terms.values()))
     # initialize PhraseMatcher
     matcher = PhraseMatcher(prep_terms[0].vocab, attr="lemma")
     for term_id, term in zip(terms.keys(), prep_terms):
@@ -23,7 +33,7 @@ def get_matcher(terms):
     return matcher
 
 
-def fuzzy_match_accuracy(source_file: str, target_file: str, terminology: Terminology, matcher: PhraseMatcher, number=None):
+def fuzzy_match_accuracy(source_file: str, target_file: str, terminology: Terminology, matcher: "PhraseMatcher", number=None):
     """
     Calculate the fuzzy match accuracy of a source and target file with a terminology.
     """
@@ -35,8 +45,8 @@ def fuzzy_match_accuracy(source_file: str, target_file: str, terminology: Termin
         print(f"Len trg: {len(trg_lines)}")
         assert len(src_lines) == len(trg_lines)
 
-        src_line_docs = SPACY_MODEL.pipe(src_lines)
-        trg_line_docs = SPACY_MODEL.pipe(trg_lines)
+        src_line_docs = get_model().pipe(src_lines)
+        trg_line_docs = get_model().pipe(trg_lines)
 
         correct_matches = 0
         incorrect_matches = 0
@@ -52,7 +62,7 @@ def fuzzy_match_accuracy(source_file: str, target_file: str, terminology: Termin
             for span_matches in match_dict.values():  # src_matches:
                 found = False
                 for src_match in span_matches:
-                    src_match_id = int(SPACY_MODEL.vocab.strings[src_match])
+                    src_match_id = int(get_model().vocab.strings[src_match])
                     matched_term = terminology.terms_by_id[src_match_id]
                     # only take the src_match into account if it has the correct number (if number is specified)
                     if number and matched_term.number != number:
@@ -60,7 +70,7 @@ def fuzzy_match_accuracy(source_file: str, target_file: str, terminology: Termin
                     correspondences = {i: terminology.terms_by_id[i] for i in matched_term.correspondences}
                     if not correspondences:
                         continue
-                    correspondences_matcher = get_matcher(correspondences)
+                    correspondences_matcher = get_matcher(correspondences, terminology)
                     trg_matches = correspondences_matcher(trg_line)
                     for i, trg_match in enumerate(trg_matches):
                         # if a target term has already been matched, this doesn't count as a correct match.
@@ -83,7 +93,7 @@ def fuzzy_match_accuracy(source_file: str, target_file: str, terminology: Termin
         return accuracy
 
 
-def gf_match_accuracy(source_file: str, target_file: str, src_matcher: PhraseMatcher):
+def gf_match_accuracy(source_file: str, target_file: str, src_matcher: "PhraseMatcher"):
     with open(source_file, 'r', encoding='utf8') as src_file, open(target_file, 'r', encoding='utf8') as trg_file:
         print(f"Evaluating {source_file} and {target_file}.")
         src_lines = src_file.readlines()
@@ -92,8 +102,8 @@ def gf_match_accuracy(source_file: str, target_file: str, src_matcher: PhraseMat
         print(f"Len trg: {len(trg_lines)}")
         assert len(src_lines) == len(trg_lines)
 
-        src_line_docs = SPACY_MODEL.pipe(src_lines)
-        trg_line_docs = SPACY_MODEL.pipe(trg_lines)
+        src_line_docs = get_model().pipe(src_lines)
+        trg_line_docs = get_model().pipe(trg_lines)
 
         correct_matches, missed_matches, additional = 0, 0, 0
         additional_reformulations = []
@@ -114,7 +124,8 @@ def gf_match_accuracy(source_file: str, target_file: str, src_matcher: PhraseMat
                     modified_text = token.text.replace("@@GFM@@innen", "").replace("@@GFM@@in", "")
                     m_modified_text = token.text.replace("@@GFM@@innen", "en").replace("@@GFM@@in", "e")
                     f_modified_text = token.text.replace("@@GFM@@innen", "innen").replace("@@GFM@@in", "in")
-                    lemma, m_lemma, f_lemma = SPACY_MODEL(modified_text)[0].lemma_, SPACY_MODEL(m_modified_text)[0].lemma_, SPACY_MODEL(f_modified_text)[0].lemma_
+                    model = get_model()
+                    lemma, m_lemma, f_lemma = model(modified_text)[0].lemma_, model(m_modified_text)[0].lemma_, model(f_modified_text)[0].lemma_
                     if m_lemma in matched_lemmas or f_lemma in matched_lemmas or lemma in matched_lemmas:
                         found_gfm_nouns += 1
                     else:
@@ -149,12 +160,13 @@ def parse_args():
     parser.add_argument("--count-additional", action="store_true")
     parser.add_argument("--out-file", required=True)
     parser.add_argument("--header", nargs="*", default=['model', 'gender', '0', '1', '11', '101', '1001', '10001'])
+    parser.add_argument("--terminology-cache", help="Directory where the parsed terminology and the spaCy docs of its terms are cached for later runs.")
     return parser.parse_args()
 
 
 def main(args):
-    terminology = Terminology(args.terminology_path)
-    matcher = get_matcher(terminology.gendered_terms)
+    terminology = Terminology(args.terminology_path, cache_dir=args.terminology_cache)
+    matcher = get_matcher(terminology.gendered_terms, terminology)
 
     src_files = [f for f in os.listdir(args.source_path) if os.path.isfile(os.path.join(args.source_path, f))]
     trg_files = [f for f in os.listdir(args.target_path) if os.path.isfile(os.path.join(args.target_path, f))]